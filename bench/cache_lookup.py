@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""Measure archive cache lookup latency as the number of archives grows.
+
+For each archive count, a cache is generated in a temporary directory and
+random archives are looked up by name, then the same lookups are repeated
+with the cache's indexes dropped, to show what the indexes save.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import glacier
+
+VAULTS = ['vault-%d' % i for i in range(4)]
+INDEXES = ['archive_key_vault_name', 'archive_key_vault',
+           'archive_key_vault_tree_hash']
+
+
+def time_lookups(cache, names, lookups):
+    start = time.time()
+    for _ in xrange(lookups):
+        vault, name = random.choice(names)
+        cache.get_archive_id(vault, name)
+    return (time.time() - start) / lookups
+
+
+def time_listing(cache):
+    start = time.time()
+    list(cache.get_archive_list(VAULTS[0]))
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--archives', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--lookups', type=int, default=1000)
+    args = parser.parse_args()
+
+    print('%10s %16s %16s %14s %14s' % (
+        'archives', 'lookup (us)', 'unindexed (us)', 'list (ms)',
+        'unindexed (ms)'))
+    for count in args.archives:
+        cache_dir = tempfile.mkdtemp()
+        os.environ['XDG_CACHE_HOME'] = cache_dir
+        try:
+            store = glacier.Cache_Store()
+            cache = glacier.Archive_Cache(store, 'benchmark')
+            names = [(VAULTS[i % len(VAULTS)], 'archive-%d' % i)
+                     for i in xrange(count)]
+            store.connection.execute(
+                glacier.Archive_Cache.Archive.__table__.insert(),
+                [{'id': 'id-%d' % i, 'key': 'benchmark', 'vault': vault,
+                  'name': name, 'size': i, 'created_here': time.time()}
+                 for i, (vault, name) in enumerate(names)])
+            store.connection.execute('ANALYZE')
+            indexed = (time_lookups(cache, names, args.lookups),
+                       time_listing(cache))
+            for index in INDEXES:
+                store.connection.execute('DROP INDEX %s' % index)
+            unindexed = (time_lookups(cache, names, args.lookups),
+                         time_listing(cache))
+            store.session.close()
+            store.connection.close()
+        finally:
+            shutil.rmtree(cache_dir)
+        print('%10d %16.1f %16.1f %14.1f %14.1f' % (
+            count, indexed[0] * 1e6, unindexed[0] * 1e6,
+            indexed[1] * 1e3, unindexed[1] * 1e3))
+
+
+if __name__ == '__main__':
+    main()
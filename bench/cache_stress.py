@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""Stress the cache database with many processes writing and reading at once.
+
+For each process count, that many processes share one newly generated cache.
+Each records --writes archive uploads, the way archive upload does, and reads
+archives back in between. The script fails if any write is lost or any
+process hits an error such as "database is locked", and prints the aggregate
+read rate, which should grow with the number of processes.
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import glacier
+
+KEY = 'benchmark'
+VAULT = 'vault'
+REGION = 'us-east-1'
+
+
+def open_caches():
+    store = glacier.Cache_Store()
+    return (store, glacier.Archive_Cache(store, KEY),
+            glacier.Vault_Cache(store, KEY))
+
+
+def worker(task):
+    number, writes, reads_per_write, start = task
+    try:
+        store, cache, v_cache = open_caches()
+        # Start together, so that the processes contend.
+        time.sleep(max(0, start - time.time()))
+        reads = 0
+        read_time = 0
+        for i in xrange(writes):
+            name = 'archive-%d-%d' % (number, i)
+
+            def record_upload():
+                cache.add_archive(VAULT, name, 'id-%d-%d' % (number, i), 1)
+                v_cache.add_vault_size(VAULT, REGION, 1)
+            store.write(record_upload)
+            read_start = time.time()
+            for _ in xrange(reads_per_write):
+                cache.get_archive_id(VAULT, name)
+                reads += 1
+            read_time += time.time() - read_start
+        return reads / max(read_time, 1e-6), None
+    except Exception:
+        return 0, traceback.format_exc()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--processes', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16])
+    parser.add_argument('--writes', type=int, default=100)
+    parser.add_argument('--reads-per-write', type=int, default=20)
+    args = parser.parse_args()
+
+    failed = False
+    print('%10s %12s %16s' % ('processes', 'archives', 'reads/second'))
+    for processes in args.processes:
+        cache_dir = tempfile.mkdtemp()
+        os.environ['XDG_CACHE_HOME'] = cache_dir
+        try:
+            store, cache, v_cache = open_caches()
+            v_cache.add_vault(VAULT, REGION)
+            pool = multiprocessing.Pool(processes)
+            start = time.time() + 1
+            results = pool.map(worker, [
+                (number, args.writes, args.reads_per_write, start)
+                for number in xrange(processes)])
+            pool.close()
+            pool.join()
+            store.session.expire_all()
+            archives = store.session.query(
+                glacier.Archive_Cache.Archive).count()
+            size = dict(v_cache.get_vault_sizes(REGION))[VAULT]
+        finally:
+            shutil.rmtree(cache_dir)
+        print('%10d %12d %16.0f' % (processes, archives,
+                                    sum(rate for rate, _ in results)))
+        for _, error in results:
+            if error:
+                print(error, file=sys.stderr)
+                failed = True
+        if archives != processes * args.writes or size != archives:
+            print('lost writes: expected %d archives, found %d, vault size %d'
+                  % (processes * args.writes, archives, size),
+                  file=sys.stderr)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""Measure per-command latency with and without a running daemon.
+
+Each command is run --runs times as a fresh process against a generated
+cache, first with no daemon running and then with `glacier daemon` serving
+it, and the median wall clock time of each is printed. No command here makes
+a network request, so the difference is the start-up work the daemon saves.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import glacier
+import startup
+
+GLACIER = os.path.join(startup.ROOT, 'glacier.py')
+COMMANDS = [
+    ['vault', 'list', '--cached'],
+    ['archive', 'checkpresent', 'vault', 'archive-1'],
+    ['archive', 'checkpresent', 'vault', 'missing'],
+]
+
+
+def time_command(command, env, runs):
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in xrange(runs):
+            start = time.time()
+            subprocess.check_call([sys.executable, GLACIER] + command,
+                                  env=env, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+    return startup.median(times)
+
+
+def wait_for_socket(path, daemon, timeout=30):
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if daemon.poll() is not None or time.time() > deadline:
+            raise RuntimeError('daemon did not start')
+        time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        cache_dir = os.path.join(tmp, 'cache')
+        glacier.mkdir_p(os.path.join(cache_dir, 'glacier-cli'))
+        startup.make_cache(cache_dir)
+        socket_path = os.path.join(tmp, 'socket')
+        env = dict(os.environ, XDG_CACHE_HOME=cache_dir, HOME=tmp,
+                   AWS_ACCESS_KEY_ID=startup.KEY,
+                   AWS_SECRET_ACCESS_KEY='benchmark',
+                   GLACIER_CLI_SOCKET=socket_path)
+        cold = [time_command(command, env, args.runs)
+                for command in COMMANDS]
+        with open(os.devnull, 'w') as devnull:
+            daemon = subprocess.Popen([sys.executable, GLACIER, 'daemon'],
+                                      env=env, stdout=devnull,
+                                      stderr=devnull)
+        try:
+            wait_for_socket(socket_path, daemon)
+            warm = [time_command(command, env, args.runs)
+                    for command in COMMANDS]
+        finally:
+            daemon.terminate()
+            daemon.wait()
+        print('%-40s %12s %12s' % ('command', 'cold (ms)', 'daemon (ms)'))
+        for command, cold_time, warm_time in zip(COMMANDS, cold, warm):
+            print('%-40s %12.1f %12.1f' % (' '.join(command), cold_time * 1e3,
+                                           warm_time * 1e3))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
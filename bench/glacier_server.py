@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""A local stand-in for the Glacier multipart upload API, for benchmarks.
+
+Only the requests that a multipart upload makes are answered. Part data is
+read and counted but not kept. Each request can be delayed by a fixed round
+trip latency, and each connection limited to a byte rate, so that a single
+connection behaves roughly like one over a long distance link.
+"""
+
+from __future__ import print_function
+
+import BaseHTTPServer
+import SocketServer
+import itertools
+import json
+import re
+import threading
+import time
+
+import boto.glacier.layer1
+import boto.regioninfo
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _read_body(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        rate = self.server.connection_rate
+        start = time.time()
+        received = 0
+        while remaining:
+            data = self.rfile.read(min(remaining, 64 * 1024))
+            if not data:
+                break
+            remaining -= len(data)
+            received += len(data)
+            if rate:
+                # Hold this connection to its share of the link.
+                delay = start + received / float(rate) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        return received
+
+    def _handle(self):
+        time.sleep(self.server.latency)
+        path = self.path.split('?')[0]
+        uploads = re.match(r'^/[^/]+/vaults/([^/]+)/multipart-uploads$', path)
+        upload = re.match(
+            r'^/[^/]+/vaults/([^/]+)/multipart-uploads/([^/]+)$', path)
+        if self.command == 'POST' and uploads:
+            upload_id = 'upload-%d' % next(self.server.ids)
+            self._reply(201, {'x-amz-multipart-upload-id': upload_id,
+                              'Location': path + '/' + upload_id})
+        elif self.command == 'PUT' and upload:
+            size = self._read_body()
+            with self.server.lock:
+                self.server.received += size
+            self._reply(204, {'x-amz-sha256-tree-hash':
+                              self.headers.get('x-amz-sha256-tree-hash')})
+        elif self.command == 'POST' and upload:
+            archive_id = 'archive-%d' % next(self.server.ids)
+            self._reply(201, {'x-amz-archive-id': archive_id,
+                              'Location': path + '/' + archive_id})
+        elif self.command == 'DELETE' and upload:
+            self._reply(204)
+        else:
+            body = json.dumps({'code': 'NotImplemented', 'message': path})
+            self.send_response(400)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0, connection_rate=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.latency = latency
+        self.connection_rate = connection_rate
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.received = 0
+
+    def handle_error(self, request, client_address):
+        # Clients drop their keep-alive connections when they exit.
+        pass
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def layer1(self):
+        """Return a boto Layer1 that talks to this server."""
+        region = boto.regioninfo.RegionInfo(name='local',
+                                            endpoint='127.0.0.1')
+        return boto.glacier.layer1.Layer1(
+            aws_access_key_id='AKIDBENCHMARK',
+            aws_secret_access_key='benchmark', region=region,
+            is_secure=False, port=self.server_address[1])
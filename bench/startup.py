@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""Measure glacier-cli start-up time for subcommands answered locally.
+
+Each command is run --runs times as a fresh process against a generated
+cache, with no daemon running, and the median wall clock time is printed,
+along with the time taken just to import glacier.py. No command here makes
+a network request.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import glacier
+
+KEY = 'AKIDBENCHMARK'
+IMPORT = ('import time; start = time.time(); import glacier; '
+          'print(time.time() - start)')
+COMMANDS = [
+    ['config', 'create', '{tmp}/config'],
+    ['config', 'stat'],
+    ['vault', 'list', '--cached'],
+    ['archive', 'checkpresent', 'vault', 'archive-1'],
+    ['archive', 'checkpresent', 'vault', 'missing'],
+]
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def make_cache(cache_dir):
+    os.environ['XDG_CACHE_HOME'] = cache_dir
+    with open(os.path.join(cache_dir, 'glacier-cli', 'config'), 'w') as f:
+        f.write('us-east-1\nyes\n30\n')
+    store = glacier.Cache_Store()
+    cache = glacier.Archive_Cache(store, KEY)
+    v_cache = glacier.Vault_Cache(store, KEY)
+    v_cache.add_vault('vault', 'us-east-1')
+    for i in xrange(1000):
+        cache.add_archive('vault', 'archive-%d' % i, 'id-%d' % i, i)
+    store.session.query(glacier.Archive_Cache.Archive).update(
+        {'last_seen_upstream': int(time.time())})
+    store.commit()
+    store.session.close()
+    store.connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        cache_dir = os.path.join(tmp, 'cache')
+        glacier.mkdir_p(os.path.join(cache_dir, 'glacier-cli'))
+        make_cache(cache_dir)
+        env = dict(os.environ, XDG_CACHE_HOME=cache_dir, HOME=tmp,
+                   AWS_ACCESS_KEY_ID=KEY, AWS_SECRET_ACCESS_KEY='benchmark',
+                   GLACIER_CLI_SOCKET=os.path.join(tmp, 'no-daemon'))
+        imports = [float(subprocess.check_output(
+            [sys.executable, '-c', IMPORT], cwd=ROOT, env=env))
+            for _ in xrange(args.runs)]
+        print('%-40s %8.1f ms' % ('import glacier', median(imports) * 1e3))
+        with open(os.devnull, 'w') as devnull:
+            for command in COMMANDS:
+                label = ' '.join(command).replace('{tmp}/', '')
+                command = [part.format(tmp=tmp) for part in command]
+                times = []
+                for _ in xrange(args.runs):
+                    start = time.time()
+                    subprocess.check_call(
+                        [sys.executable, os.path.join(ROOT, 'glacier.py')] +
+                        command, env=env, stdout=devnull, stderr=devnull)
+                    times.append(time.time() - start)
+                print('%-40s %8.1f ms' % (label, median(times) * 1e3))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""Measure archive upload throughput against a local stand-in for Glacier.
+
+A file of random data is uploaded with increasing --parallel values. Each
+connection to the stand-in is limited to --connection-rate bytes per second
+and each request delayed by --latency seconds, so that the benchmark shows
+what concurrent parts gain over a long distance link rather than over
+loopback.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import glacier
+import glacier_server
+
+
+class Vault(object):
+    name = 'benchmark'
+
+    def __init__(self, layer1):
+        self.layer1 = layer1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=glacier.parse_size, default='128M')
+    parser.add_argument('--part-size', type=glacier.parse_size, default='8M')
+    parser.add_argument('--parallel', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('--connection-rate', type=glacier.parse_size,
+                        default='16M')
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+
+    glacier.import_boto()
+    server = glacier_server.Server(args.latency, args.connection_rate)
+    server.start()
+    vault = Vault(server.layer1())
+    glacier.sign_with_content_hash(vault.layer1)
+    with tempfile.TemporaryFile() as f:
+        for _ in xrange(0, args.size, glacier.MEGABYTE):
+            f.write(os.urandom(glacier.MEGABYTE))
+        f.truncate(args.size)
+        print('%8s %10s %10s' % ('parallel', 'seconds', 'MB/s'))
+        for parallel in args.parallel:
+            f.seek(0)
+            start = time.time()
+            glacier.App._upload_file(vault, f, 'benchmark', args.size,
+                                     args.part_size, parallel)
+            elapsed = time.time() - start
+            print('%8d %10.2f %10.1f' % (parallel, elapsed,
+                                         args.size / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    main()
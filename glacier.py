@@ -25,21 +25,35 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import binascii
 import calendar
+import codecs
 import errno
+import functools
+import hashlib
+import httplib
+import io
 import itertools
+import json
+import mmap
 import os
 import os.path
+import Queue
+import random
 import sys
+import tarfile
+import tempfile
+import threading
 import time
 import re
 import datetime
+import socket
+import stat
+import traceback
 
-import boto.glacier
-import iso8601
-import sqlalchemy
-import sqlalchemy.ext.declarative
-import sqlalchemy.orm
+# boto, iso8601 and SQLAlchemy are slow to import, and some invocations need
+# only some of them (or none, eg. config create). So they are only imported
+# when first needed; see import_boto and import_sqlalchemy.
 
 
 # There is a lag between an archive being created and the archive
@@ -50,8 +64,41 @@ import sqlalchemy.orm
 # uploaded successfully.
 INVENTORY_LAG = 24 * 60 * 60 * 3
 
+# Glacier retrieval jobs typically complete in around four hours. Jobs are
+# polled between these intervals (in seconds), more often as that time nears.
+EXPECTED_JOB_DURATION = 4 * 60 * 60
+MINIMUM_POLL_INTERVAL = 2 * 60
+MAXIMUM_POLL_INTERVAL = 30 * 60
+
+# The daemon keeps its job index between commands, but lists each vault's jobs
+# again once the listing is this many seconds old.
+DAEMON_JOB_LIST_MAX_AGE = 60
+
 PROGRAM_NAME = 'glacier'
 
+# Glacier computes its SHA-256 tree hashes over 1 MiB leaves, and multipart
+# upload part sizes must be a power of two multiple of this.
+MEGABYTE = 1024 * 1024
+DEFAULT_PART_SIZE = 8 * MEGABYTE
+MAXIMUM_PART_SIZE = 4096 * MEGABYTE
+MAXIMUM_PARTS = 10000
+# The size of a stream is not known in advance, so use parts big enough for
+# MAXIMUM_PARTS of them to hold a multi-terabyte stream (2.5 TiB).
+DEFAULT_STREAM_PART_SIZE = 256 * MEGABYTE
+
+# Many glacier processes (eg. parallel git-annex jobs) may share the cache.
+# SQLite waits up to CACHE_BUSY_TIMEOUT seconds for another writer to finish,
+# and a write that still finds the database locked is retried this many times.
+CACHE_BUSY_TIMEOUT = 30
+CACHE_WRITE_ATTEMPTS = 5
+
+# How often to report the rate of a transfer, in seconds.
+TRANSFER_REPORT_INTERVAL = 10
+# Tries in all for each part or range of a transfer, and the delay before the
+# first retry, in seconds, which doubles for each retry after.
+TRANSFER_ATTEMPTS = 5
+TRANSFER_RETRY_DELAY = 1
+
 class ConsoleError(RuntimeError):
     def __init__(self, m):
         self.message = m
@@ -93,7 +140,28 @@ def insert_prefix_to_lines(prefix, lines):
     return "\n".join([prefix + line for line in lines.split("\n")])
 
 
+def import_boto():
+    global boto
+    import boto.exception
+    import boto.glacier
+    import boto.glacier.exceptions
+    import boto.glacier.job
+    import boto.glacier.layer1
+    import boto.glacier.utils
+    import boto.glacier.vault
+
+
+def import_sqlalchemy():
+    global sqlalchemy
+    import sqlalchemy
+    import sqlalchemy.exc
+    import sqlalchemy.ext.declarative
+    import sqlalchemy.orm
+    import sqlalchemy.orm.exc
+
+
 def iso8601_to_unix_timestamp(iso8601_date_str):
+    import iso8601
     return calendar.timegm(iso8601.parse_date(iso8601_date_str).utctimetuple())
 
 
@@ -117,7 +185,12 @@ def get_user_credential_dir():
         raise RuntimeError('Cannot find user home directory')
     return os.path.join(home,'.boto')
 
-class Vault_Cache(object):
+def declare_cache_models():
+    """Declare the cache's SQLAlchemy models, on first use only."""
+    if hasattr(Cache_Store, 'Base'):
+        return
+    import_sqlalchemy()
+
     Base = sqlalchemy.ext.declarative.declarative_base()
     class Vault(Base):
         __tablename__ = 'vault'
@@ -130,26 +203,194 @@ class Vault_Cache(object):
         last_retrieved = sqlalchemy.Column(sqlalchemy.String)
 
         def __init__(self, *args, **kwargs):
-            super(Vault_Cache.Vault, self).__init__(*args, **kwargs)
-            
-    Session = sqlalchemy.orm.sessionmaker()
+            super(Vault, self).__init__(*args, **kwargs)
 
-    def __init__(self, key):
-        self.key = key
-        db_path = os.path.join(get_user_cache_dir(), 'glacier-cli', 'vault_cache')
+    class Archive(Base):
+        __tablename__ = 'archive'
+        id = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+        name = sqlalchemy.Column(sqlalchemy.String)
+        vault = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+        key = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+        last_seen_upstream = sqlalchemy.Column(sqlalchemy.Integer)
+        created_here = sqlalchemy.Column(sqlalchemy.Integer)
+        deleted_here = sqlalchemy.Column(sqlalchemy.Integer)
+        size = sqlalchemy.Column(sqlalchemy.Integer)
+        # The modification time of the file uploaded, if it was one.
+        mtime = sqlalchemy.Column(sqlalchemy.Float)
+        sha256_tree_hash = sqlalchemy.Column(sqlalchemy.String)
+
+        def __init__(self, *args, **kwargs):
+            self.created_here = time.time()
+            super(Archive, self).__init__(*args, **kwargs)
+
+    class Member(Base):
+        """A file packed into a bundle archive by archive upload-tree."""
+        __tablename__ = 'member'
+        archive_id = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+        offset = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        key = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+        vault = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+        name = sqlalchemy.Column(sqlalchemy.String)
+        size = sqlalchemy.Column(sqlalchemy.Integer)
+        mtime = sqlalchemy.Column(sqlalchemy.Float)
+        sha256 = sqlalchemy.Column(sqlalchemy.String)
+
+    Cache_Store.Base = Base
+    Cache_Store.Session = sqlalchemy.orm.sessionmaker()
+    Vault_Cache.Vault = Vault
+    Archive_Cache.Archive = Archive
+    Archive_Cache.Member = Member
+
+
+def migrate_schema(engine, migrations):
+    """Bring the database behind engine up to date with migrations.
+
+    migrations is a list of steps, each a list of SQL statements or a
+    function to call with the connection. SQLite's user_version records how
+    many steps have been applied. Steps run after create_all, so adding a
+    column that a new database already has is fine.
+    """
+    connection = engine.connect()
+    try:
+        applied = connection.execute('PRAGMA user_version').scalar()
+        for version, statements in enumerate(migrations[applied:],
+                                             applied + 1):
+            if callable(statements):
+                statements(connection)
+                statements = []
+            for statement in statements:
+                try:
+                    connection.execute(statement)
+                except sqlalchemy.exc.OperationalError, e:
+                    if 'duplicate column name' not in str(e):
+                        raise
+            connection.execute('PRAGMA user_version = %d' % version)
+    finally:
+        connection.close()
+
+
+def import_legacy_caches(connection):
+    """Copy the contents of the old per-table cache files, if any.
+
+    Earlier versions kept vaults and archives in separate vault_cache and
+    archive_cache databases. The old files are left in place.
+    """
+    cache_dir = os.path.join(get_user_cache_dir(), 'glacier-cli')
+    for filename, table, columns in [
+            ('vault_cache', 'vault',
+             'name, region, key, last_synced, size, current_retrieval, '
+             'last_retrieved'),
+            ('archive_cache', 'archive',
+             'id, name, vault, key, last_seen_upstream, created_here, '
+             'deleted_here, size')]:
+        path = os.path.join(cache_dir, filename)
+        if not os.path.exists(path):
+            continue
+        connection.execute('ATTACH DATABASE ? AS legacy', path)
+        try:
+            if connection.execute(
+                    "SELECT COUNT(*) FROM legacy.sqlite_master "
+                    "WHERE type = 'table' AND name = ?", table).scalar():
+                connection.execute(
+                    'INSERT OR IGNORE INTO main.%s (%s) '
+                    'SELECT %s FROM legacy.%s' %
+                    (table, columns, columns, table))
+        finally:
+            connection.execute('DETACH DATABASE legacy')
+
+
+def cache_write(method):
+    """Make a cache method commit its changes through Cache_Store.write."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.store.write(method, self, *args, **kwargs)
+    return wrapper
+
+
+class Cache_Store(object):
+    """The SQLite database holding the vault and archive caches.
+
+    Both caches share one engine, connection and session, so changes to
+    vaults and archives commit together. The database is in WAL mode so that
+    readers in other processes are not blocked by a writer.
+    """
+    # Base and Session are set by declare_cache_models.
+
+    MIGRATIONS = [
+        import_legacy_caches,
+        # Lookups by name and archive listings only consider archives that
+        # have not been deleted here; syncs look at every archive in a vault.
+        ['CREATE INDEX IF NOT EXISTS vault_key_region_name '
+         'ON vault (key, region, name)',
+         'CREATE INDEX IF NOT EXISTS archive_key_vault_name '
+         'ON archive (key, vault, name) WHERE deleted_here IS NULL',
+         'CREATE INDEX IF NOT EXISTS archive_key_vault '
+         'ON archive (key, vault)'],
+        ['ALTER TABLE archive ADD COLUMN mtime FLOAT'],
+        ['CREATE INDEX IF NOT EXISTS member_key_vault_name '
+         'ON member (key, vault, name)'],
+        ['ALTER TABLE archive ADD COLUMN sha256_tree_hash VARCHAR',
+         'CREATE INDEX IF NOT EXISTS archive_key_vault_tree_hash '
+         'ON archive (key, vault, sha256_tree_hash)'],
+    ]
+
+    def __init__(self):
+        declare_cache_models()
+        db_path = os.path.join(get_user_cache_dir(), 'glacier-cli', 'db')
         mkdir_p(os.path.dirname(db_path))
-        self.engine = sqlalchemy.create_engine('sqlite:///%s' % db_path)
-        self.Base.metadata.create_all(self.engine)
-        self.Session.configure(bind=self.engine)
-        self.session = self.Session()
+        self.engine = sqlalchemy.create_engine(
+            'sqlite:///%s' % db_path,
+            connect_args={'timeout': CACHE_BUSY_TIMEOUT})
+        # Temporary tables such as inventory_staging belong to a connection,
+        # so keep one open for the session rather than one per transaction.
+        self.connection = self.engine.connect()
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.Base.metadata.create_all(self.connection)
+        migrate_schema(self.engine, self.MIGRATIONS)
+        self.session = self.Session(bind=self.connection)
+
+    def commit(self):
+        self.session.commit()
+
+    def write(self, func, *args, **kwargs):
+        """Call func, commit its changes and return its result.
+
+        If the database is locked by another process for longer than
+        CACHE_BUSY_TIMEOUT, or a transaction that has already read has to
+        wait for a writer, the changes are rolled back and func is called
+        again after a short random delay. So func must do all of its reading
+        and writing itself, and keep it brief, and must leave any reporting
+        to its caller.
+        """
+        for attempt in xrange(CACHE_WRITE_ATTEMPTS):
+            try:
+                result = func(*args, **kwargs)
+                self.session.commit()
+                return result
+            except sqlalchemy.exc.OperationalError, e:
+                self.session.rollback()
+                if ('database is locked' not in str(e) or
+                        attempt == CACHE_WRITE_ATTEMPTS - 1):
+                    raise
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+
+
+class Vault_Cache(object):
+    # Vault is set by declare_cache_models.
 
+    def __init__(self, store, key):
+        self.key = key
+        self.store = store
+        self.session = store.session
+
+    @cache_write
     def add_vault(self, name, region):
         result = self.get_vault(name, region)
         try:
             result.one().name
         except sqlalchemy.orm.exc.NoResultFound:
             self.session.add(self.Vault(key=self.key, name=name, region=region, size=0, current_retrieval=0))
-            self.session.commit()
     
     def get_vault(self, name, region):
         return self.session.query(self.Vault).filter_by(
@@ -162,14 +403,64 @@ class Vault_Cache(object):
                                        region=region).
                              order_by(self.Vault.name)):
             yield vault.name
+    @cache_write
     def delete_vault(self, name, region):
         try:
             result = self.get_vault(name,region).one()
             self.session.delete(result)
-            self.session.commit()
         except sqlalchemy.orm.exc.NoResultFound:
             return 1
 
+    def get_vault_sizes(self, region):
+        return [(vault.name, vault.size) for vault in
+                self.session.query(self.Vault).
+                             filter_by(key=self.key,
+                                       region=region).
+                             order_by(self.Vault.name)]
+
+    @cache_write
+    def reconcile_vaults(self, region, vaults):
+        """Make the cache match vaults, a complete list of (name, size).
+
+        Sizes are updated, new vaults added and vaults no longer listed
+        removed in a single transaction.
+        """
+        sizes = dict(vaults)
+        for vault in self.session.query(self.Vault).filter_by(
+                key=self.key, region=region):
+            if vault.name in sizes:
+                vault.size = sizes.pop(vault.name)
+            else:
+                self.session.delete(vault)
+        for name, size in sizes.items():
+            self.session.add(self.Vault(key=self.key, name=name,
+                                        region=region, size=size,
+                                        current_retrieval=0))
+
+    def add_vault_size(self, name, region, size):
+        for vault in self.get_vault(name, region):
+            vault.size += size
+
+    @cache_write
+    def get_current_retrieval(self, region, today):
+        """Return the bytes retrieved today from the vaults in region.
+
+        Each vault's count is reset on the first call of a new day.
+        """
+        size = 0
+        for vault in self.session.query(self.Vault).filter_by(
+                key=self.key, region=region):
+            if vault.last_retrieved != today:
+                vault.current_retrieval = 0
+                vault.last_retrieved = today
+            size += vault.current_retrieval
+        return size
+
+    @cache_write
+    def add_current_retrieval(self, name, region, size):
+        for vault in self.get_vault(name, region):
+            vault.current_retrieval += size
+
     def total_vault_size(self, region):
         size = 0
         for vault in (
@@ -184,37 +475,30 @@ class Vault_Cache(object):
         self.session.commit()
 
 class Archive_Cache(object):
-    Base = sqlalchemy.ext.declarative.declarative_base()
-    class Archive(Base):
-        __tablename__ = 'archive'
-        id = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
-        name = sqlalchemy.Column(sqlalchemy.String)
-        vault = sqlalchemy.Column(sqlalchemy.String, nullable=False)
-        key = sqlalchemy.Column(sqlalchemy.String, nullable=False)
-        last_seen_upstream = sqlalchemy.Column(sqlalchemy.Integer)
-        created_here = sqlalchemy.Column(sqlalchemy.Integer)
-        deleted_here = sqlalchemy.Column(sqlalchemy.Integer)
-        size = sqlalchemy.Column(sqlalchemy.Integer)
+    # Archive and Member are set by declare_cache_models.
 
-        def __init__(self, *args, **kwargs):
-            self.created_here = time.time()
-            super(Archive_Cache.Archive, self).__init__(*args, **kwargs)
-
-    Session = sqlalchemy.orm.sessionmaker()
-
-    def __init__(self, key):
+    def __init__(self, store, key):
         self.key = key
-        db_path = os.path.join(get_user_cache_dir(), 'glacier-cli', 'archive_cache')
-        mkdir_p(os.path.dirname(db_path))
-        self.engine = sqlalchemy.create_engine('sqlite:///%s' % db_path)
-        self.Base.metadata.create_all(self.engine)
-        self.Session.configure(bind=self.engine)
-        self.session = self.Session()
+        self.store = store
+        self.session = store.session
 
-    def add_archive(self, vault, name, id, size):
+    def add_archive(self, vault, name, id, size, mtime=None,
+                    sha256_tree_hash=None):
+        # Not committed here, so that the caller can commit it together with
+        # the matching vault size change.
         self.session.add(self.Archive(key=self.key,
-                                      vault=vault, name=name, id=id, size=size))
-        self.session.commit()
+                                      vault=vault, name=name, id=id, size=size,
+                                      mtime=mtime,
+                                      sha256_tree_hash=sha256_tree_hash))
+
+    def get_archive_ref_by_tree_hash(self, vault, sha256_tree_hash, size):
+        """Return a ref to an archive in vault with this content."""
+        archive = self.session.query(self.Archive).filter_by(
+                key=self.key, vault=vault, deleted_here=None,
+                sha256_tree_hash=sha256_tree_hash, size=size).first()
+        if archive is None:
+            raise KeyError(sha256_tree_hash)
+        return self._archive_ref(archive)
 
     def _get_archive_query_by_ref(self, vault, ref):
         if ref.startswith('id:'):
@@ -242,20 +526,113 @@ class Archive_Cache(object):
             raise KeyError(ref)
         return result.name
 
+    def get_archive_names(self, vault, ids, batch_size=500):
+        """Return a dict mapping each of ids that is in the cache to its name.
+
+        IDs are looked up in batches to stay within SQLite's limit on the
+        number of query parameters.
+        """
+        ids = list(set(ids))
+        names = {}
+        for i in xrange(0, len(ids), batch_size):
+            for id, name in (
+                    self.session.query(self.Archive.id, self.Archive.name).
+                                 filter_by(key=self.key,
+                                           vault=vault,
+                                           deleted_here=None).
+                                 filter(self.Archive.id.in_(
+                                     ids[i:i + batch_size]))):
+                names[id] = name
+        return names
+
     def get_archive_last_seen(self, vault, ref):
         try:
             result = self._get_archive_query_by_ref(vault, ref).one()
         except sqlalchemy.orm.exc.NoResultFound:
             raise KeyError(ref)
+        except sqlalchemy.orm.exc.MultipleResultsFound:
+            raise KeyError(ref)
         return result.last_seen_upstream or result.created_here
 
+    def get_archive_file_stats(self, vault):
+        """Return the set of (name, size, mtime) of the files in vault.
+
+        This covers both files uploaded as archives and bundle members.
+        """
+        stats = set(self.session.query(self.Archive.name,
+                                       self.Archive.size,
+                                       self.Archive.mtime).
+                                 filter_by(key=self.key,
+                                           vault=vault,
+                                           deleted_here=None))
+        stats.update(self._get_member_query(vault).with_entities(
+            self.Member.name, self.Member.size, self.Member.mtime))
+        return stats
+
+    def add_member(self, vault, archive_id, name, offset, size, mtime,
+                   sha256):
+        # Not committed here, like add_archive.
+        self.session.add(self.Member(key=self.key, vault=vault,
+                                     archive_id=archive_id, name=name,
+                                     offset=offset, size=size, mtime=mtime,
+                                     sha256=sha256))
+
+    def _get_member_query(self, vault):
+        # Members of bundles that have been deleted are gone too.
+        return (self.session.query(self.Member).
+                             join(self.Archive,
+                                  self.Archive.id == self.Member.archive_id).
+                             filter(self.Member.key == self.key,
+                                    self.Member.vault == vault,
+                                    self.Archive.deleted_here == None))
+
+    def get_member(self, vault, name):
+        try:
+            return self._get_member_query(vault).filter(
+                self.Member.name == name).one()
+        except sqlalchemy.orm.exc.NoResultFound:
+            raise KeyError(name)
+        except sqlalchemy.orm.exc.MultipleResultsFound:
+            raise KeyError(name)
+
+    def get_member_list(self, vault):
+        for member in self._get_member_query(vault).order_by(
+                self.Member.name):
+            yield 'member:%s' % member.name
+
+    def get_archive_last_seen_by_name(self, vault):
+        """Return a dict mapping archive names in vault to their last seen time.
+
+        This is what get_archive_last_seen would return for each name, from a
+        single query. Names shared by more than one archive are left out.
+        """
+        last_seen = {}
+        shared = set()
+        for name, last_seen_upstream, created_here in (
+                self.session.query(self.Archive.name,
+                                   self.Archive.last_seen_upstream,
+                                   self.Archive.created_here).
+                             filter_by(key=self.key,
+                                       vault=vault,
+                                       deleted_here=None)):
+            if name is None:
+                continue
+            if name in last_seen:
+                shared.add(name)
+            last_seen[name] = last_seen_upstream or created_here
+        for name in shared:
+            del last_seen[name]
+        return last_seen
+
+    @cache_write
     def delete_archive(self, vault, ref):
         try:
             result = self._get_archive_query_by_ref(vault, ref).one()
         except sqlalchemy.orm.exc.NoResultFound:
-            raise KeyError(name)
+            raise KeyError(ref)
         result.deleted_here = time.time()
-        self.session.commit()
+        self.session.query(self.Member).filter_by(
+            key=self.key, vault=vault, archive_id=result.id).delete()
 
     @staticmethod
     def _archive_ref(archive, force_id=False):
@@ -301,10 +678,34 @@ class Archive_Cache(object):
                 for subsequent_archive in archive_iterator:
                     yield force_id(subsequent_archive)
 
-    def mark_seen_upstream(
-            self, vault, id, name, upstream_creation_date,
-            upstream_inventory_date, upstream_inventory_job_creation_date,size,
-            fix=False):
+    def start_inventory(self):
+        """Prepare an empty staging table for an inventory reconciliation.
+
+        The staging table is temporary and private to this process, so it
+        can be filled without holding a lock on the cache. Commit the staged
+        inventory before reconciling it with mark_staged_seen_upstream and
+        mark_only_seen.
+        """
+        self.session.execute(sqlalchemy.text(
+            'CREATE TEMPORARY TABLE IF NOT EXISTS inventory_staging ('
+            'id VARCHAR PRIMARY KEY, name VARCHAR, size INTEGER, '
+            'tree_hash VARCHAR)'))
+        self.session.execute(sqlalchemy.text(
+            'DELETE FROM inventory_staging'))
+
+    def stage_inventory(self, archives):
+        """Add (id, name, size, tree_hash) inventory records to the staging
+        table."""
+        self.session.execute(
+            sqlalchemy.text('INSERT OR REPLACE INTO inventory_staging '
+                            '(id, name, size, tree_hash) '
+                            'VALUES (:id, :name, :size, :tree_hash)'),
+            [{'id': id, 'name': name, 'size': size, 'tree_hash': tree_hash}
+             for id, name, size, tree_hash in archives])
+
+    def mark_staged_seen_upstream(
+            self, vault, upstream_inventory_date,
+            upstream_inventory_job_creation_date, fix=False):
 
         # Inventories don't get recreated unless the vault has changed.
         # See: https://forums.aws.amazon.com/thread.jspa?threadID=106541
@@ -327,76 +728,232 @@ class Archive_Cache(object):
         # it's too far back in time than too far ahead.
         #
         # With thanks to Wolfgang Nagele.
+        #
+        # Returns the warnings to report, as (warn, message) pairs, rather
+        # than reporting them, as this may run again if the commit fails.
 
+        reports = []
         last_seen_upstream = max(
             upstream_inventory_date,
             upstream_inventory_job_creation_date - INVENTORY_LAG
             )
-
-        try:
-            archive = self.session.query(self.Archive).filter_by(
-                key=self.key, vault=vault, id=id).one()
-        except sqlalchemy.orm.exc.NoResultFound:
-            self.session.add(
-                self.Archive(
-                    key=self.key, vault=vault, name=name, id=id,
-                    last_seen_upstream=last_seen_upstream, size=size
-                    )
-                )
+        params = {'key': self.key, 'vault': vault,
+                  'last_seen_upstream': last_seen_upstream,
+                  'created_here': time.time()}
+        execute = lambda sql: self.session.execute(sqlalchemy.text(sql),
+                                                   params)
+        known = ('archive.key = :key AND archive.vault = :vault AND '
+                 'archive.id IN (SELECT id FROM inventory_staging)')
+
+        for archive in execute(
+                'SELECT archive.id, archive.name, inventory_staging.name '
+                'AS upstream_name FROM archive JOIN inventory_staging '
+                'ON inventory_staging.id = archive.id '
+                'WHERE archive.key = :key AND archive.vault = :vault AND '
+                "archive.name IS NOT NULL AND archive.name != '' AND "
+                'archive.name IS NOT inventory_staging.name').fetchall():
+            if fix:
+                reports.append((warn, 'archive %r appears to have changed '
+                                'name from %r ' % (archive.id, archive.name) +
+                                'to %r (fixed)' % (archive.upstream_name)))
+            else:
+                reports.append((warn, 'archive %r appears to have changed '
+                                'name from %r ' % (archive.id, archive.name) +
+                                'to %r' % (archive.upstream_name)))
+        # Take the upstream name for archives we have no name for and, when
+        # fixing, for those that have changed name too.
+        if fix:
+            stale_name = '1'
         else:
-            if not archive.name:
-                archive.name = name
-            elif archive.name != name:
-                if fix:
-                    warn('archive %r appears to have changed name from %r ' %
-                         (archive.id, archive.name) + 'to %r (fixed)' % (name))
-                    archive.name = name
-                else:
-                    warn('archive %r appears to have changed name from %r ' %
-                         (archive.id, archive.name) + 'to %r' % (name))
-            if archive.deleted_here:
-                archive_ref = self._archive_ref(archive)
-                if archive.deleted_here < upstream_inventory_date:
-                    warn('archive %r marked deleted but still present' %
-                         archive_ref)
-                else:
-                    warn('archive %r deletion not yet in inventory' %
-                         archive_ref)
-            archive.last_seen_upstream = last_seen_upstream
-
-    def mark_only_seen(self, vault, inventory_date, ids, fix=False):
-        upstream_ids = set(ids)
-        our_ids = set([r[0] for r in
-                self.session.query(self.Archive.id)
-                            .filter_by(key=self.key, vault=vault).all()])
-        missing_ids = our_ids - upstream_ids
-        for id in missing_ids:
-            archive = (self.session.query(self.Archive)
-                                   .filter_by(key=self.key,
-                                              vault=vault, id=id)
-                                   .one())
+            stale_name = "archive.name IS NULL OR archive.name = ''"
+        execute('UPDATE archive SET name = (SELECT inventory_staging.name '
+                'FROM inventory_staging '
+                'WHERE inventory_staging.id = archive.id) '
+                'WHERE %s AND (%s)' % (known, stale_name))
+
+        for archive in execute(
+                'SELECT id, name, deleted_here FROM archive WHERE %s AND '
+                'deleted_here IS NOT NULL AND deleted_here != 0' %
+                known).fetchall():
             archive_ref = self._archive_ref(archive)
-            if archive.deleted_here and archive.deleted_here < inventory_date:
-                self.session.delete(archive)
-                info('deleted archive %r has left inventory; ' % archive_ref +
-                     'removed from cache')
-            elif not archive.deleted_here and (
-                  archive.last_seen_upstream or
-                    (archive.created_here and
-                     archive.created_here < inventory_date - INVENTORY_LAG)):
-                if fix:
-                    self.session.delete(archive)
-                    warn('archive disappeared: %r (removed from cache)' %
-                         archive_ref)
-                else:
-                    warn('archive disappeared: %r' % archive_ref)
+            if archive.deleted_here < upstream_inventory_date:
+                reports.append((warn, 'archive %r marked deleted but still '
+                                'present' % archive_ref))
+            else:
+                reports.append((warn, 'archive %r deletion not yet in '
+                                'inventory' % archive_ref))
+
+        execute('UPDATE archive SET last_seen_upstream = :last_seen_upstream, '
+                'sha256_tree_hash = (SELECT inventory_staging.tree_hash '
+                'FROM inventory_staging '
+                'WHERE inventory_staging.id = archive.id) '
+                'WHERE %s' % known)
+        execute('INSERT INTO archive '
+                '(id, name, vault, key, last_seen_upstream, created_here, '
+                'size, sha256_tree_hash) '
+                'SELECT id, name, :vault, :key, :last_seen_upstream, '
+                ':created_here, size, tree_hash FROM inventory_staging '
+                'WHERE id NOT IN (SELECT id FROM archive '
+                'WHERE key = :key AND vault = :vault)')
+        # The ORM has not seen any of these changes.
+        self.session.expire_all()
+        return reports
+
+    def mark_only_seen(self, vault, inventory_date, fix=False,
+                       sample_size=10):
+        # Like mark_staged_seen_upstream, returns what to report.
+        reports = []
+        params = {'key': self.key, 'vault': vault,
+                  'inventory_date': inventory_date,
+                  'created_before': inventory_date - INVENTORY_LAG}
+        execute = lambda sql: self.session.execute(sqlalchemy.text(sql),
+                                                   params)
+        # Archives we know about that are missing from the staged inventory,
+        # classified the same way for the summaries and the delete below.
+        missing = ('key = :key AND vault = :vault AND NOT EXISTS '
+                   '(SELECT 1 FROM inventory_staging '
+                   'WHERE inventory_staging.id = archive.id)')
+        deleted = ('deleted_here IS NOT NULL AND deleted_here != 0 AND '
+                   'deleted_here < :inventory_date')
+        disappeared = ('(deleted_here IS NULL OR deleted_here = 0) AND '
+                       '((last_seen_upstream IS NOT NULL AND '
+                       'last_seen_upstream != 0) OR '
+                       '(created_here IS NOT NULL AND created_here != 0 AND '
+                       'created_here < :created_before))')
+        not_yet_seen = 'NOT (%s) AND NOT (%s)' % (deleted, disappeared)
+
+        def summarize(condition, report, one, many):
+            where = '%s AND %s' % (missing, condition)
+            count = execute('SELECT COUNT(*) FROM archive WHERE %s' %
+                            where).scalar()
+            if not count:
+                return
+            refs = [self._archive_ref(archive) for archive in execute(
+                    'SELECT id, name FROM archive WHERE %s '
+                    'ORDER BY name, id LIMIT %d' % (where, sample_size))]
+            if count == 1:
+                reports.append((report, one % refs[0]))
             else:
-                warn('new archive not yet in inventory: %r' % archive_ref)
+                refs = ', '.join(repr(ref) for ref in refs)
+                if count > sample_size:
+                    refs += ' and %d more' % (count - sample_size)
+                reports.append((report, many % (count, refs)))
+
+        summarize(deleted, info,
+                  'deleted archive %r has left inventory; removed from cache',
+                  '%d deleted archives have left inventory; '
+                  'removed from cache: %s')
+        if fix:
+            summarize(disappeared, warn,
+                      'archive disappeared: %r (removed from cache)',
+                      '%d archives disappeared (removed from cache): %s')
+            removed = '%s AND ((%s) OR (%s))' % (missing, deleted,
+                                                disappeared)
+        else:
+            summarize(disappeared, warn, 'archive disappeared: %r',
+                      '%d archives disappeared: %s')
+            removed = '%s AND %s' % (missing, deleted)
+        execute('DELETE FROM archive WHERE %s' % removed)
+        # Bundle members go with their archives, including those left behind
+        # by versions that did not remove them.
+        execute('DELETE FROM member WHERE key = :key AND vault = :vault AND '
+                'NOT EXISTS (SELECT 1 FROM archive '
+                'WHERE archive.id = member.archive_id)')
+        summarize(not_yet_seen, warn, 'new archive not yet in inventory: %r',
+                  '%d new archives not yet in inventory: %s')
+        self.session.expire_all()
+        return reports
 
     def mark_commit(self):
         self.session.commit()
 
 
+class Inventory_Reader(object):
+    """Incrementally parse a vault inventory from a file-like object.
+
+    Iterating yields the entries of ArchiveList one at a time while holding
+    only a small read buffer. The other top level fields (such as
+    InventoryDate) are collected into fields as they go past.
+    """
+
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, f, chunk_size=64 * 1024):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.fields = {}
+        self.bytes_read = 0
+        self.archives_read = 0
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            raise ValueError('inventory ends unexpectedly')
+        data = self.f.read(self.chunk_size)
+        self.bytes_read += len(data)
+        self._eof = not data
+        self._buffer = (self._buffer[self._pos:] +
+                        self._utf8.decode(data, final=self._eof))
+        self._pos = 0
+
+    def _peek(self):
+        """Skip whitespace and return the next character."""
+        while True:
+            self._pos = self.whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            self._fill()
+
+    def _expect(self, characters):
+        c = self._peek()
+        if c not in characters:
+            raise ValueError('unexpected %r in inventory' % c)
+        self._pos += 1
+        return c
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                pass
+            else:
+                # A number at the end of the buffer might continue in the
+                # next chunk, so only trust a value followed by a delimiter.
+                if self._eof or (end < len(self._buffer) and
+                                 self._buffer[end] in ' \t\n\r,:]}'):
+                    self._pos = end
+                    return value
+            self._fill()
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'ArchiveList':
+                self._expect('[')
+                if self._peek() != ']':
+                    while True:
+                        yield self._value()
+                        self.archives_read += 1
+                        if self._expect(',]') == ']':
+                            break
+                else:
+                    self._pos += 1
+            else:
+                self.fields[key] = self._value()
+            if self._expect(',}') == '}':
+                return
+
+
 def get_connection_account(connection):
     """Return some account key associated with the connection.
 
@@ -409,11 +966,203 @@ def get_connection_account(connection):
     return connection.layer1.aws_access_key_id
 
 
-def find_retrieval_jobs(vault, archive_id):
-    return [job for job in vault.list_jobs() if job.archive_id == archive_id]
+def list_all_vaults(connection):
+    """Return every vault, following list_vaults pagination markers."""
+    layer1 = connection.layer1
+    vaults = []
+    marker = None
+    while True:
+        response = layer1.list_vaults(marker=marker)
+        vaults.extend(boto.glacier.vault.Vault(layer1, vault_data)
+                      for vault_data in response['VaultList'])
+        marker = response.get('Marker')
+        if not marker:
+            return vaults
+
+
+def get_job_output_stream(job):
+    """Return the raw HTTP response for a job's output.
+
+    Job.get_output reads and parses JSON output (such as an inventory) in one
+    go; this leaves the body unread so that it can be streamed instead.
+    """
+    layer1 = job.vault.layer1
+    response = super(boto.glacier.layer1.Layer1, layer1).make_request(
+        'GET', '/%s/vaults/%s/jobs/%s/output' % (
+            layer1.account_id, job.vault.name, job.id),
+        headers={'x-amz-glacier-version': layer1.Version})
+    if response.status != 200:
+        raise boto.glacier.exceptions.UnexpectedHTTPResponseError(
+            (200,), response)
+    return response
+
+
+class Job_Index(object):
+    """Per-invocation index of the jobs in each vault.
+
+    Each vault's job list is fetched at most once, following pagination
+    markers, and its jobs are indexed by archive ID and action. After that,
+    only the individual jobs being waited on are refreshed.
+
+    An index that outlives one invocation (see App.daemon) should set
+    max_age, in seconds, after which a vault's job list is fetched again.
+    """
+
+    def __init__(self, max_age=None):
+        self.lock = threading.Lock()
+        self.max_age = max_age
+        self.vault_jobs = {}
+        self.vault_loaded = {}
+        self.jobs_by_archive = {}
+        self.jobs_by_id = {}
+
+    def _forget(self, vault_name):
+        for job_id in self.vault_jobs.pop(vault_name, []):
+            self.jobs_by_id.pop(job_id, None)
+        for key in self.jobs_by_archive.keys():
+            if key[0] == vault_name:
+                del self.jobs_by_archive[key]
+
+    def jobs(self, vault):
+        """Return every job in vault."""
+        with self.lock:
+            loaded = self.vault_loaded.get(vault.name)
+            if (loaded is not None and self.max_age is not None and
+                    time.time() - loaded > self.max_age):
+                del self.vault_loaded[vault.name]
+                loaded = None
+        if loaded is None:
+            jobs = []
+            marker = None
+            while True:
+                response = vault.layer1.list_jobs(vault.name, marker=marker)
+                jobs.extend(make_job(vault, job_data)
+                            for job_data in response['JobList'])
+                marker = response.get('Marker')
+                if not marker:
+                    break
+            with self.lock:
+                if vault.name not in self.vault_loaded:
+                    # Drop jobs left from an earlier listing or refresh.
+                    self._forget(vault.name)
+                    self.vault_loaded[vault.name] = time.time()
+                    self.vault_jobs[vault.name] = []
+                    for job in jobs:
+                        self._add(job)
+        with self.lock:
+            return [self.jobs_by_id[job_id]
+                    for job_id in self.vault_jobs[vault.name]]
+
+    def _add(self, job):
+        if job.id not in self.jobs_by_id:
+            self.vault_jobs.setdefault(job.vault.name, []).append(job.id)
+            self.jobs_by_archive.setdefault(
+                (job.vault.name, job.archive_id, job.action), []).append(
+                    job.id)
+        self.jobs_by_id[job.id] = job
+
+    def add(self, job):
+        """Index a job that was just created."""
+        with self.lock:
+            if job.vault.name in self.vault_jobs:
+                self._add(job)
+
+    def find(self, vault, archive_id, action):
+        self.jobs(vault)
+        with self.lock:
+            return [self.jobs_by_id[job_id] for job_id in
+                    self.jobs_by_archive.get(
+                        (vault.name, archive_id, action), [])]
+
+    def refresh(self, jobs):
+        """Fetch the current state of jobs, updating the list in place."""
+        for i, job in enumerate(jobs):
+            jobs[i] = describe_job(job.vault, job.id)
+            with self.lock:
+                self._add(jobs[i])
+
+
+def make_job(vault, job_data):
+    """Make a boto Job from Glacier's description of it.
+
+    boto drops the RetrievalByteRange of archive retrievals, so keep it as
+    retrieval_byte_range; see job_byte_range.
+    """
+    job = boto.glacier.job.Job(vault, job_data)
+    job.retrieval_byte_range = job_data.get('RetrievalByteRange')
+    return job
+
+
+def describe_job(vault, job_id):
+    return make_job(vault, vault.layer1.describe_job(vault.name, job_id))
+
+
+def retrieve_archive_range(vault, archive_id, byte_range):
+    """Start a job retrieving the (start, end) bytes of an archive."""
+    response = vault.layer1.initiate_job(vault.name, {
+        'Type': 'archive-retrieval',
+        'ArchiveId': archive_id,
+        'RetrievalByteRange': '%d-%d' % byte_range})
+    return describe_job(vault, response['JobId'])
 
 
-def find_inventory_jobs(vault, max_age_hours=0):
+def job_byte_range(job):
+    """Return the (start, end) bytes of the archive that job retrieves.
+
+    Returns None if the job retrieves the whole archive.
+    """
+    byte_range = getattr(job, 'retrieval_byte_range', None)
+    if not byte_range:
+        return None
+    start, end = [int(value) for value in byte_range.split('-')]
+    if start == 0 and end == job.archive_size - 1:
+        return None
+    return start, end
+
+
+def job_output_size(job):
+    byte_range = job_byte_range(job)
+    if byte_range is None:
+        return job.archive_size
+    return byte_range[1] - byte_range[0] + 1
+
+
+def parse_byte_range(value):
+    """Parse START-END, an inclusive range of bytes, for argparse."""
+    try:
+        start, end = [int(part) for part in value.split('-')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected START-END, not %r' % value)
+    if not 0 <= start <= end:
+        raise argparse.ArgumentTypeError('invalid byte range %r' % value)
+    return start, end
+
+
+def align_byte_range(start, end, archive_size):
+    """Widen the bytes start to end to the range a retrieval job must cover.
+
+    Glacier only retrieves ranges that start and end on megabyte boundaries,
+    or at the end of the archive.
+    """
+    start -= start % MEGABYTE
+    end = min(end - end % MEGABYTE + MEGABYTE, archive_size) - 1
+    return start, end
+
+
+def find_retrieval_jobs(job_index, vault, archive_id, byte_range=None):
+    """Find the jobs retrieving archive_id, or at least its byte_range."""
+    jobs = job_index.find(vault, archive_id, 'ArchiveRetrieval')
+    if byte_range is None:
+        return [job for job in jobs if job_byte_range(job) is None]
+
+    def covers(job):
+        job_range = job_byte_range(job)
+        return job_range is None or (job_range[0] <= byte_range[0] and
+                                     byte_range[1] <= job_range[1])
+    return [job for job in jobs if covers(job)]
+
+
+def find_inventory_jobs(job_index, vault, max_age_hours=0):
     if max_age_hours:
         def recent_enough(job):
             if not job.completed:
@@ -425,11 +1174,12 @@ def find_inventory_jobs(vault, max_age_hours=0):
         def recent_enough(job):
             return not job.completed
 
-    return [job for job in vault.list_jobs()
-            if job.action == 'InventoryRetrieval' and recent_enough(job)]
+    return [job for job in job_index.find(vault, None, 'InventoryRetrieval')
+            if recent_enough(job)]
 
 
 def find_complete_job(jobs):
+    import iso8601
     for job in sorted(filter(lambda job: job.completed, jobs), key=lambda job: iso8601.parse_date(job.completion_date), reverse=True):
         return job
 
@@ -438,12 +1188,7 @@ def has_pending_job(jobs):
     return any(filter(lambda job: not job.completed, jobs))
 
 
-def update_job_list(jobs):
-    for i, job in enumerate(jobs):
-        jobs[i] = job.vault.get_job(job.id)
-
-
-def job_oneline(conn, cache, vault, job):
+def job_oneline(vault, job, archive_name):
     action_letter = {'ArchiveRetrieval': 'a',
                      'InventoryRetrieval': 'i'}[job.action]
     status_letter = {'InProgress': 'p',
@@ -453,42 +1198,1169 @@ def job_oneline(conn, cache, vault, job):
     if not date:
         date = job.creation_date
     if job.action == 'ArchiveRetrieval':
-        try:
-            name = cache.get_archive_name(vault.name, 'id:' + job.archive_id)
-        except KeyError:
-            name = None
+        name = archive_name
         if name is None:
             name = 'id:' + job.archive_id
+        byte_range = job_byte_range(job)
+        if byte_range is not None:
+            name += ' [%d-%d]' % byte_range
     elif job.action == 'InventoryRetrieval':
         name = ''
     return '{action_letter}/{status_letter} {date} {vault.name:10} {name}'.format(
             **locals())
 
 
-def wait_until_job_completed(jobs, sleep=600, tries=144):
-    update_job_list(jobs)
-    job = find_complete_job(jobs)
-    while not job:
-        tries -= 1
-        if tries < 0:
-            raise RuntimeError('Timed out waiting for job completion')
-        time.sleep(sleep)
-        update_job_list(jobs)
+def job_json(vault, job, archive_name):
+    return json.dumps({'vault': vault.name,
+                       'id': job.id,
+                       'action': job.action,
+                       'status': job.status_code,
+                       'creation_date': job.creation_date,
+                       'completion_date': job.completion_date,
+                       'archive_id': job.archive_id,
+                       'archive_name': archive_name,
+                       'retrieval_byte_range': getattr(
+                           job, 'retrieval_byte_range', None)})
+
+
+def job_poll_interval(jobs):
+    """Return how long to wait before polling jobs again.
+
+    Polls are rare while the jobs are young and become more frequent as the
+    oldest of them approaches EXPECTED_JOB_DURATION.
+    """
+    created = min(iso8601_to_unix_timestamp(job.creation_date) for job in jobs)
+    remaining = created + EXPECTED_JOB_DURATION - time.time()
+    return min(MAXIMUM_POLL_INTERVAL, max(MINIMUM_POLL_INTERVAL, remaining / 2))
+
+
+class Job_Poller(object):
+    """Wait for many jobs together.
+
+    Each added group of jobs is polled at its own adaptive interval, and
+    groups that are due are polled concurrently. As soon as any job in a
+    group completes, the group's callback is run with it in a separate
+    thread, so callbacks (such as downloads) overlap with further waiting.
+    """
+
+    def __init__(self, job_index, parallel=8, workers=4,
+                 timeout=24 * 60 * 60):
+        self.job_index = job_index
+        self.parallel = parallel
+        self.workers = threading.Semaphore(workers)
+        self.deadline = time.time() + timeout
+        self.waiting = []
+        self.threads = []
+        self.errors = []
+
+    def add(self, jobs, callback):
+        jobs = list(jobs)
         job = find_complete_job(jobs)
+        if job:
+            self._start(callback, job)
+        else:
+            self.waiting.append([jobs, callback,
+                                 time.time() + job_poll_interval(jobs)])
 
-    return job
+    def _start(self, callback, job):
+        def run():
+            with self.workers:
+                try:
+                    callback(job)
+                except Exception:
+                    self.errors.append(sys.exc_info())
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def run(self):
+        """Wait until every group has completed and its callback returned."""
+        while self.waiting:
+            now = time.time()
+            if now > self.deadline:
+                raise RuntimeError('Timed out waiting for job completion')
+            due = [waiting for waiting in self.waiting if waiting[2] <= now]
+            if not due:
+                time.sleep(min(waiting[2] for waiting in self.waiting) - now)
+                continue
+            run_in_parallel(lambda waiting: self.job_index.refresh(waiting[0]),
+                            due, self.parallel)
+            for waiting in due:
+                jobs, callback, next_poll = waiting
+                job = find_complete_job(jobs)
+                if job:
+                    self.waiting.remove(waiting)
+                    self._start(callback, job)
+                else:
+                    waiting[2] = time.time() + job_poll_interval(jobs)
+        self.join()
+
+    def join(self):
+        """Wait for the callbacks started so far, leaving any other group
+        waiting."""
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(1)
+        if self.errors:
+            exc_type, exc_value, exc_traceback = self.errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+
+def wait_until_job_completed(job_index, jobs):
+    completed = []
+    poller = Job_Poller(job_index)
+    poller.add(jobs, completed.append)
+    poller.run()
+    return completed[0]
+
+
+def run_in_parallel(func, items, workers):
+    """Call func on each of items using up to workers threads.
+
+    Results are returned in the same order as items. If any call raises, the
+    remaining items are abandoned and the first exception is re-raised here.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = Queue.Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                index, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Join with a timeout so that KeyboardInterrupt is still delivered.
+        while thread.is_alive():
+            thread.join(1)
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+
+def byte_ranges(size, part_size):
+    """Return (start, end) pairs covering size bytes in part_size pieces.
+
+    end is exclusive; the final range may be shorter than part_size.
+    """
+    return [(start, min(start + part_size, size))
+            for start in xrange(0, size, part_size)]
+
+
+class Tree_Hasher(object):
+    """Incremental SHA-256 tree hash, as used by Glacier.
+
+    Each 1 MiB leaf is hashed as its bytes arrive. Only the roots of the
+    complete subtrees seen so far are kept, so memory use is logarithmic in
+    the amount of data hashed.
+    """
+
+    def __init__(self):
+        self.leaf = hashlib.sha256()
+        self.leaf_size = 0
+        self.leaf_count = 0
+        # (level, digest) for each complete subtree, largest first.
+        self.subtrees = []
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            n = min(len(view), MEGABYTE - self.leaf_size)
+            self.leaf.update(view[:n])
+            self.leaf_size += n
+            view = view[n:]
+            if self.leaf_size == MEGABYTE:
+                self._add_leaf()
+
+    def _add_leaf(self):
+        level, digest = 0, self.leaf.digest()
+        while self.subtrees and self.subtrees[-1][0] == level:
+            digest = hashlib.sha256(self.subtrees.pop()[1] + digest).digest()
+            level += 1
+        self.subtrees.append((level, digest))
+        self.leaf = hashlib.sha256()
+        self.leaf_size = 0
+        self.leaf_count += 1
+
+    def digest(self):
+        digests = [digest for level, digest in self.subtrees]
+        if self.leaf_size or not self.leaf_count:
+            digests.append(self.leaf.digest())
+        # Unpaired subtrees are promoted unchanged, so folding the remaining
+        # roots from the right gives the same result as the full tree.
+        result = digests.pop()
+        while digests:
+            result = hashlib.sha256(digests.pop() + result).digest()
+        return result
+
+    def hexdigest(self):
+        return binascii.hexlify(self.digest())
+
+
+SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': MEGABYTE, 'G': 1024 * MEGABYTE}
+
+
+def parse_size(value):
+    """Parse a size in bytes, with an optional K, M or G suffix."""
+    match = re.match(r'^(\d+(?:\.\d+)?)([KMG]?)(?:I?B)?$', value.upper())
+    if not match or not float(match.group(1)):
+        raise argparse.ArgumentTypeError('invalid size %r' % value)
+    return int(float(match.group(1)) * SIZE_SUFFIXES[match.group(2)])
+
+
+def is_congestion_error(e):
+    """Whether e means that Glacier or the network is overloaded."""
+    if isinstance(e, socket.error):
+        # Includes socket.timeout.
+        return True
+    # boto's UnexpectedHTTPResponseError, tested by attribute as boto is
+    # imported lazily.
+    return (getattr(e, 'status', None) in (429, 500, 503) or
+            getattr(e, 'code', None) in ('ThrottlingException',
+                                         'RequestTimeoutException'))
+
+
+def is_retryable_error(e, cut_off=False):
+    """Whether a transfer that failed with e is worth trying again here.
+
+    boto itself retries a request that fails with a network error or a 5xx
+    response, so only throttling and request timeout responses, which it
+    does not retry, are tried again, along with network errors in a response
+    body that boto had already returned (cut_off).
+    """
+    if cut_off and isinstance(e, (socket.error, httplib.HTTPException)):
+        return True
+    return (getattr(e, 'status', None) in (408, 429) or
+            getattr(e, 'code', None) in ('ThrottlingException',
+                                         'RequestTimeoutException'))
+
+
+class Connection_Stats(object):
+    """Counts the HTTP connections that a boto connection uses and opens.
+
+    boto keeps a pool of keep-alive connections for each connection object,
+    shared by every thread using it, and only opens a new one when none in
+    the pool is free. The requests each thread sends are counted too, as
+    boto signs every attempt at a request, including its own retries.
+    """
+
+    def __init__(self, layer1):
+        self.lock = threading.Lock()
+        self.used = 0
+        self.opened = 0
+        self.local = threading.local()
+        get_http_connection = layer1.get_http_connection
+        new_http_connection = layer1.new_http_connection
+        add_auth = layer1._auth_handler.add_auth
+
+        def counting_get_http_connection(*args):
+            with self.lock:
+                self.used += 1
+            return get_http_connection(*args)
+
+        def counting_new_http_connection(*args):
+            with self.lock:
+                self.opened += 1
+            return new_http_connection(*args)
+
+        # boto looks these up on the instance, including from its own
+        # get_http_connection.
+        layer1.get_http_connection = counting_get_http_connection
+        layer1.new_http_connection = counting_new_http_connection
+
+        def counting_add_auth(*args, **kwargs):
+            self.local.requests = self.requests() + 1
+            return add_auth(*args, **kwargs)
+
+        layer1._auth_handler.add_auth = counting_add_auth
+
+    def requests(self):
+        """Return the number of requests this thread has sent so far."""
+        return getattr(self.local, 'requests', 0)
+
+    def snapshot(self):
+        with self.lock:
+            return self.used, self.opened
+
+
+def sign_with_content_hash(layer1):
+    """Have layer1 sign requests with the body hash that they already carry.
+
+    boto's S3 signer uses a request's x-amz-content-sha256 header, but the
+    one that Glacier uses reads and hashes the body again for every attempt,
+    which for a part upload is a second pass over the part, and one that a
+    throttled Part_Body would count against the bandwidth limit.
+    """
+    auth_handler = layer1._auth_handler
+    payload = auth_handler.payload
+
+    def known_payload(http_request):
+        return (http_request.headers.get('x-amz-content-sha256') or
+                payload(http_request))
+
+    auth_handler.payload = known_payload
+
+
+class Transfer_Controller(object):
+    """Bandwidth limit and adaptive concurrency shared by transfer workers.
+
+    Workers call start before sending or fetching a part and finish after.
+    Only window of them may be busy at once: the window grows by one for
+    each round of window parts that is faster than the round before, and is
+    halved when a part fails with a congestion error (AIMD). max_bandwidth,
+    in bytes per second, is enforced by a token bucket that throttle draws
+    on. The rate and window are reported on stderr as the transfer goes.
+
+    A part that fails in a way that boto does not retry itself is tried
+    again, on its own, after a jittered exponential backoff. Retries, both
+    these and boto's as counted by connection_stats, and the bytes that they
+    send or fetch again are counted, along with connections reused from and
+    opened for connection_stats, and report_totals reports them.
+    """
+
+    def __init__(self, max_window, max_bandwidth=None, connection_stats=None,
+                 attempts=TRANSFER_ATTEMPTS,
+                 report_interval=TRANSFER_REPORT_INTERVAL):
+        self.max_window = max(1, max_window)
+        self.window = self.max_window
+        self.max_bandwidth = max_bandwidth
+        self.report_interval = report_interval
+        self.condition = threading.Condition()
+        self.active = 0
+        self.tokens = max_bandwidth
+        self.refilled = time.time()
+        self.bucket_lock = threading.Lock()
+        self.transferred = 0
+        self.round_start = self.reported = self.refilled
+        self.round_bytes = self.round_parts = 0
+        self.round_rate = None
+        self.report_bytes = 0
+        self.attempts = attempts
+        self.parts = self.retries = self.resent = 0
+        self.connection_stats = connection_stats
+        if connection_stats is not None:
+            self.connections = connection_stats.snapshot()
+
+    def start(self):
+        with self.condition:
+            while self.active >= self.window:
+                # Wait with a timeout so that KeyboardInterrupt is delivered.
+                self.condition.wait(1)
+            self.active += 1
+
+    def finish(self, size, error=None):
+        with self.condition:
+            self.active -= 1
+            if error is not None:
+                if is_congestion_error(error):
+                    self.window = max(1, self.window // 2)
+                    self._start_round(None)
+            else:
+                self.parts += 1
+                self.transferred += size
+                self.report_bytes += size
+                self.round_bytes += size
+                self.round_parts += 1
+                if self.round_parts >= self.window:
+                    self._end_round()
+                self._report()
+            self.condition.notify_all()
+
+    def _start_round(self, rate):
+        self.round_rate = rate
+        self.round_start = time.time()
+        self.round_bytes = self.round_parts = 0
+
+    def _end_round(self):
+        rate = self.round_bytes / max(time.time() - self.round_start, 1e-6)
+        if self.round_rate is None or rate > self.round_rate:
+            if self.window < self.max_window:
+                self.window += 1
+        self._start_round(rate)
+
+    def _report(self):
+        now = time.time()
+        if now - self.reported >= self.report_interval:
+            info('transferring at %.1f MB/s with %d of up to %d connections'
+                 % (self.report_bytes / (now - self.reported) / MEGABYTE,
+                    self.window, self.max_window))
+            self.reported = now
+            self.report_bytes = 0
+
+    def throttle(self, size):
+        """Wait until size bytes may be sent or received."""
+        if not self.max_bandwidth:
+            return
+        with self.bucket_lock:
+            now = time.time()
+            # The bucket holds up to a second's worth of tokens; taking more
+            # than there are puts it into debt, paid off by waiting.
+            self.tokens = min(
+                self.max_bandwidth,
+                self.tokens + (now - self.refilled) * self.max_bandwidth)
+            self.refilled = now
+            self.tokens -= size
+            delay = -self.tokens / float(self.max_bandwidth)
+        if delay > 0:
+            time.sleep(delay)
+
+    def retry(self, attempt, error, resent, cut_off=False):
+        """Whether to try again after attempt failed with error.
+
+        If so, first wait a random time of up to twice as long as the last
+        wait. resent is the number of bytes that the next attempt sends or
+        fetches again; cut_off is as for is_retryable_error.
+        """
+        if (attempt + 1 >= self.attempts or
+                not is_retryable_error(error, cut_off)):
+            return False
+        with self.condition:
+            self.retries += 1
+            self.resent += resent
+        delay = random.uniform(0, TRANSFER_RETRY_DELAY * 2 ** attempt)
+        info('%s; retrying in %.1f seconds' % (error, delay))
+        time.sleep(delay)
+        return True
+
+    def requests(self):
+        """Return a count of requests to pass to count_boto_retries."""
+        if self.connection_stats is None:
+            return 0
+        return self.connection_stats.requests()
+
+    def count_boto_retries(self, requests, resent):
+        """Count the retries that boto made of the one request this thread
+        has sent since requests() returned requests.
+
+        boto only retries after a network error or a 5xx response, so the
+        window is halved as for a congestion error. Each retry sent resent
+        bytes again.
+        """
+        retries = max(0, self.requests() - requests - 1)
+        if retries:
+            with self.condition:
+                self.retries += retries
+                self.resent += retries * resent
+                self.window = max(1, self.window // 2)
+                self._start_round(None)
+
+    def call(self, size, func, *args, **kwargs):
+        """Call func, which sends size bytes in one request, in a slot of the
+        window.
+
+        func should send its body through a Part_Body given throttle, so
+        that it is sent no faster than the bandwidth limit, retries included.
+        """
+        for attempt in itertools.count():
+            self.start()
+            requests = self.requests()
+            try:
+                result = func(*args, **kwargs)
+            except Exception, e:
+                self.count_boto_retries(requests, size)
+                self.finish(size, e)
+                if self.retry(attempt, e, size):
+                    continue
+                raise
+            self.count_boto_retries(requests, size)
+            self.finish(size)
+            return result
+
+    def report_totals(self):
+        """Report retries and connection reuse, if there was much to do."""
+        if self.parts < 2 and not self.retries:
+            return
+        message = '%d parts, %d retries, %d bytes sent or fetched again' % (
+            self.parts, self.retries, self.resent)
+        if self.connection_stats is not None:
+            used, opened = [now - then for now, then in zip(
+                self.connection_stats.snapshot(), self.connections)]
+            message += '; %d connections reused, %d opened' % (
+                max(0, used - opened), opened)
+        info(message)
+
+
+def copy_job_output(job, byte_range, write, chunk_size=MEGABYTE,
+                    controller=None):
+    """Stream a job's output (or byte_range of it) to write in chunks.
+
+    The data is tree hashed as it arrives and checked against the tree hash
+    that Glacier sends for tree hash aligned ranges. Returns the digest. If
+    controller is given, the transfer takes a slot in its window, the chunks
+    are read no faster than its bandwidth limit, and if the response is cut
+    off or throttled the rest of the range is fetched again, carrying on from
+    the last byte written.
+    """
+    if byte_range:
+        start, end = byte_range
+    else:
+        start, end = 0, job_output_size(job) - 1
+    hasher = Tree_Hasher()
+    received = 0
+    expected = None
+    request_range = byte_range
+    for attempt in itertools.count():
+        if controller is not None:
+            controller.start()
+            requests = controller.requests()
+        attempt_start = received
+        response = None
+        try:
+            response = job.get_output(request_range)
+            if controller is not None:
+                controller.count_boto_retries(requests, 0)
+            if expected is None:
+                # Only sent for the range first asked for.
+                expected = response.get('TreeHash') or ''
+            while True:
+                data = response.read(chunk_size)
+                if not data:
+                    break
+                if controller is not None:
+                    controller.throttle(len(data))
+                hasher.update(data)
+                write(data)
+                received += len(data)
+            if received < end - start + 1:
+                raise httplib.IncompleteRead(b'', end - start + 1 - received)
+        except Exception, e:
+            if controller is None:
+                raise
+            if response is None:
+                controller.count_boto_retries(requests, 0)
+            controller.finish(received - attempt_start, e)
+            # boto has already retried a request that failed outright, but
+            # not one whose body was cut off.
+            if controller.retry(attempt, e, 0,
+                                cut_off=response is not None):
+                request_range = (start + received, end)
+                continue
+            raise
+        if controller is not None:
+            controller.finish(received - attempt_start)
+        break
+    if expected and expected != hasher.hexdigest():
+        if byte_range:
+            where = 'bytes %d-%d' % byte_range
+        else:
+            where = 'output'
+        raise ConsoleError('tree hash mismatch in %s of job %s' %
+                           (where, job.id))
+    return hasher.digest()
+
+
+def check_archive_tree_hash(job, tree_hash, name):
+    if (tree_hash is not None and job.sha256_treehash and
+            job.sha256_treehash != boto.glacier.utils.bytes_to_hex(tree_hash)):
+        raise ConsoleError('archive %r failed tree hash verification' % name)
+
+
+def pwrite(fd, data, offset):
+    """Write all of data to fd at offset.
+
+    Python 2 has no os.pwrite, so fall back to seeking first. This is only
+    safe because callers never share a descriptor between threads.
+    """
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+class Range_Journal(object):
+    """Sidecar record of the byte ranges of a retrieval already on disk.
+
+    The journal lives next to the output file and is keyed on the archive and
+    range size, so a later run can resume from any job retrieving the same
+    archive while the partially written output file still exists. It is
+    append only: a header line, then one line per range written, holding the
+    range's tree hash so that the whole archive can still be verified.
+    """
+
+    def __init__(self, filename, archive_id, archive_size, part_size):
+        self.path = filename + '.glacier-journal'
+        key = {'archive_id': archive_id,
+               'archive_size': archive_size,
+               'part_size': part_size}
+        self.lock = threading.Lock()
+        self.done = {}
+        try:
+            with open(self.path, 'r') as f:
+                if (json.loads(f.readline()) == key and
+                        os.path.exists(filename)):
+                    for line in f:
+                        start, end, tree_hash = json.loads(line)
+                        self.done[(start, end)] = tree_hash
+        except (IOError, ValueError):
+            # A missing journal, or a torn final line after a crash; any
+            # ranges read so far are still good.
+            pass
+        if self.done:
+            self.log = open(self.path, 'a')
+        else:
+            self.log = open(self.path, 'w')
+            self.log.write(json.dumps(key) + '\n')
+            self.log.flush()
+
+    def missing(self, ranges):
+        return [r for r in ranges if r not in self.done]
+
+    def mark_done(self, byte_range, tree_hash):
+        with self.lock:
+            self.done[tuple(byte_range)] = tree_hash
+            self.log.write(json.dumps(list(byte_range) + [tree_hash]) + '\n')
+            self.log.flush()
+            os.fsync(self.log.fileno())
+
+    def remove(self):
+        self.log.close()
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def imap_unordered(func, items, workers):
+    """Call func on each of items using up to workers threads.
+
+    Yields (item, result) pairs in the order that the calls finish. If a call
+    raises, the exception is re-raised here when its turn comes.
+    """
+    items = list(items)
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+    finished = Queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                finished.put((item, func(item), None))
+            except Exception:
+                finished.put((item, None, sys.exc_info()))
+
+    for _ in range(max(1, min(workers, len(items)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+    for _ in items:
+        while True:
+            # Wait with a timeout so that KeyboardInterrupt is delivered.
+            try:
+                item, result, error = finished.get(True, 1)
+            except Queue.Empty:
+                continue
+            break
+        if error:
+            exc_type, exc_value, exc_traceback = error
+            raise exc_type, exc_value, exc_traceback
+        yield item, result
+
+
+def pack_bundle(files, f):
+    """Write files, a list of (path, name, size, mtime), to f as a tar file.
+
+    Returns (name, offset, size, mtime, sha256) for each file, where offset is
+    the position of the file's data in the tar file.
+    """
+    members = []
+    # Names are unicode; stored as UTF-8 whatever the locale.
+    tar = tarfile.open(fileobj=f, mode='w', encoding='utf-8')
+    for path, name, size, mtime in files:
+        with open(path, 'rb') as member_file:
+            # Small files only, so read them whole.
+            data = member_file.read()
+        tarinfo = tar.gettarinfo(path, arcname=name)
+        tarinfo.size = len(data)
+        tar.addfile(tarinfo, io.BytesIO(data))
+        # The data follows the header, padded to a whole number of blocks.
+        offset = tar.offset - (len(data) + tarfile.BLOCKSIZE - 1) // (
+            tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        members.append((name, offset, len(data), mtime,
+                        hashlib.sha256(data).hexdigest()))
+    tar.close()
+    return members
+
+
+def read_response(response):
+    """Read the rest of a boto Layer1 response's body and return it.
+
+    boto only reuses a pooled connection once the response on it has been
+    read to the end, which Layer1 does not do for responses that have no
+    JSON body, such as those to multipart upload requests.
+    """
+    response.read()
+    return response
+
+
+def is_valid_part_size(part_size):
+    return (MEGABYTE <= part_size <= MAXIMUM_PART_SIZE and
+            part_size & (part_size - 1) == 0)
+
+
+def upload_archive_multipart(vault, file_obj, description, size, part_size,
+                             parallel, controller=None):
+    """Upload size bytes of file_obj as a multipart archive.
+
+    Returns the archive ID and its tree hash. file_obj must be seekable.
+    Parts are read, tree hashed and uploaded by parallel worker threads, and
+    the upload is completed with the tree hash combined from the part tree
+    hashes. Parts are sent under controller, a Transfer_Controller.
+    """
+    if controller is None:
+        controller = Transfer_Controller(parallel)
+    layer1 = vault.layer1
+    upload_id = read_response(layer1.initiate_multipart_upload(
+        vault.name, part_size, description))['UploadId']
+    read_lock = threading.Lock()
+
+    def upload_part(start):
+        with read_lock:
+            file_obj.seek(start)
+            data = file_obj.read(part_size)
+        part_tree_hash = boto.glacier.utils.tree_hash(
+            boto.glacier.utils.chunk_hashes(data))
+        controller.call(len(data), lambda: read_response(layer1.upload_part(
+            vault.name, upload_id, hashlib.sha256(data).hexdigest(),
+            boto.glacier.utils.bytes_to_hex(part_tree_hash),
+            (start, start + len(data) - 1),
+            Part_Body(memoryview(data), controller.throttle))))
+        return part_tree_hash
+
+    try:
+        part_tree_hashes = run_in_parallel(
+            upload_part, xrange(0, size, part_size), parallel)
+        tree_hash = boto.glacier.utils.bytes_to_hex(
+            boto.glacier.utils.tree_hash(part_tree_hashes))
+        response = read_response(layer1.complete_multipart_upload(
+            vault.name, upload_id, tree_hash, size))
+    except:
+        read_response(layer1.abort_multipart_upload(vault.name, upload_id))
+        raise
+    return response['ArchiveId'], tree_hash
+
+
+class Part_Body(object):
+    """A read-only file-like view of part of a buffer.
+
+    boto hashes and sends a request body that has read and seek in small
+    pieces, so a part is uploaded without copying its buffer. Reading past the
+    end rewinds to the start, so that boto can send the part again when it
+    retries a request. If throttle is given, it is called with the size of
+    each piece read, such as Transfer_Controller.throttle to hold the part to
+    a bandwidth limit as it is sent.
+    """
+
+    def __init__(self, view, throttle=None):
+        self.view = view
+        self.position = 0
+        self.throttle = throttle
+
+    def __len__(self):
+        return len(self.view)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+        self.position = max(0, min(offset, len(self.view)))
+
+    def read(self, size=-1):
+        if self.position >= len(self.view):
+            self.position = 0
+            return b''
+        if size < 0:
+            end = len(self.view)
+        else:
+            end = min(self.position + size, len(self.view))
+        data = self.view[self.position:end].tobytes()
+        self.position = end
+        if self.throttle is not None:
+            self.throttle(len(data))
+        return data
+
+
+def read_into(f, buf):
+    """Fill buf from raw file f; return the number of bytes read.
+
+    Fewer than len(buf) bytes are read only at the end of the file.
+    """
+    view = memoryview(buf)
+    count = 0
+    while count < len(buf):
+        read = f.readinto(view[count:])
+        if not read:
+            break
+        count += read
+    return count
+
+
+def read_first_part(f, part_size):
+    """Read up to part_size bytes from raw file f into a new bytearray.
+
+    The buffer grows as data arrives, so that a stream shorter than a part
+    takes only as much memory as it holds.
+    """
+    buf = bytearray()
+    while len(buf) < part_size:
+        data = f.read(min(MEGABYTE, part_size - len(buf)))
+        if not data:
+            break
+        buf += data
+    return buf
+
+
+def upload_archive_stream(vault, file_obj, description, part_size, parallel,
+                          controller=None):
+    """Upload everything read from file_obj, which need not be seekable.
+
+    Returns the archive ID, its tree hash and its size. One thread reads
+    parts into a pool of reusable buffers, another hashes them, and parallel
+    worker threads upload them, so at most parallel + 2 parts, each of
+    part_size bytes, are held in memory however long the stream is; a stream
+    shorter than one part needs only its own size. Parts are sent under
+    controller, a Transfer_Controller.
+    """
+    if controller is None:
+        controller = Transfer_Controller(parallel)
+    layer1 = vault.layer1
+    raw = io.open(file_obj.fileno(), 'rb', buffering=0, closefd=False)
+    first = read_first_part(raw, part_size)
+    if not first:
+        raise ConsoleError('nothing to upload: the input is empty')
+    upload_id = read_response(layer1.initiate_multipart_upload(
+        vault.name, part_size, description))['UploadId']
+    pool_size = parallel + 2
+    buffers = [first]
+    free = Queue.Queue()
+    # The pool of buffers bounds these queues.
+    to_hash = Queue.Queue()
+    to_upload = Queue.Queue()
+    part_tree_hashes = {}
+    errors = []
+
+    def take(queue):
+        # Give up waiting once another stage has failed.
+        while not errors:
+            try:
+                return queue.get(True, 1)
+            except Queue.Empty:
+                pass
+        return None
+
+    def hash_parts():
+        try:
+            while True:
+                part = take(to_hash)
+                if part is None:
+                    break
+                index, buf, count = part
+                view = memoryview(buf)[:count]
+                part_tree_hash = boto.glacier.utils.tree_hash(
+                    [hashlib.sha256(view[start:start + MEGABYTE]).digest()
+                     for start in xrange(0, count, MEGABYTE)])
+                to_upload.put((index, buf, count,
+                               hashlib.sha256(view).hexdigest(),
+                               part_tree_hash))
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            for _ in xrange(parallel):
+                to_upload.put(None)
+
+    def upload_parts():
+        try:
+            while True:
+                part = take(to_upload)
+                if part is None:
+                    break
+                index, buf, count, linear_hash, part_tree_hash = part
+                start = index * part_size
+                # A retry needs a fresh view of the buffer to read.
+                controller.call(
+                    count, lambda: read_response(layer1.upload_part(
+                        vault.name, upload_id, linear_hash,
+                        boto.glacier.utils.bytes_to_hex(part_tree_hash),
+                        (start, start + count - 1),
+                        Part_Body(memoryview(buf)[:count],
+                                  controller.throttle))))
+                part_tree_hashes[index] = part_tree_hash
+                free.put(buf)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=hash_parts)]
+    threads.extend(threading.Thread(target=upload_parts)
+                   for _ in xrange(parallel))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    size = 0
+    try:
+        try:
+            index = 0
+            buf = first
+            count = len(first)
+            # A part shorter than part_size is the last.
+            while count and not errors:
+                if index == MAXIMUM_PARTS:
+                    raise ConsoleError(
+                        'input is longer than %d parts of %d bytes; use a '
+                        'larger --part-size' % (MAXIMUM_PARTS, part_size))
+                to_hash.put((index, buf, count))
+                size += count
+                index += 1
+                if count < part_size:
+                    break
+                if len(buffers) < pool_size and free.empty():
+                    # Allocate buffers only as the pipeline fills.
+                    buffers.append(bytearray(part_size))
+                    buf = buffers[-1]
+                else:
+                    buf = take(free)
+                    if buf is None:
+                        break
+                count = read_into(raw, buf)
+        except Exception:
+            # Stop the other stages too.
+            errors.append(sys.exc_info())
+        finally:
+            to_hash.put(None)
+        for thread in threads:
+            # Join with a timeout so that KeyboardInterrupt is still delivered.
+            while thread.is_alive():
+                thread.join(1)
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
+        tree_hash = boto.glacier.utils.bytes_to_hex(
+            boto.glacier.utils.tree_hash(
+                [part_tree_hashes[i] for i in xrange(len(part_tree_hashes))]))
+        response = read_response(layer1.complete_multipart_upload(
+            vault.name, upload_id, tree_hash, size))
+    except:
+        read_response(layer1.abort_multipart_upload(vault.name, upload_id))
+        raise
+    return response['ArchiveId'], tree_hash, size
+
+
+def file_tree_hash(f, size, workers):
+    """Return the hex tree hash of the first size bytes of file f.
+
+    The file is memory mapped and its 1 MiB chunks are hashed by up to
+    workers threads; hashlib releases the GIL while it hashes.
+    """
+    if not size:
+        return hashlib.sha256(b'').hexdigest()
+    mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        chunk_hashes = run_in_parallel(
+            lambda start: hashlib.sha256(
+                buffer(mapped, start, MEGABYTE)).digest(),
+            xrange(0, size, MEGABYTE), workers)
+    finally:
+        mapped.close()
+    return boto.glacier.utils.bytes_to_hex(
+        boto.glacier.utils.tree_hash(chunk_hashes))
+
+
+def get_daemon_socket_path():
+    return (os.getenv('GLACIER_CLI_SOCKET') or
+            os.path.join(get_user_cache_dir(), 'glacier-cli', 'socket'))
+
+
+# The environment that decides which account, credentials and cache a command
+# uses; see daemon_environment.
+DAEMON_ENVIRONMENT_VARIABLES = [
+    'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN',
+    'AWS_SESSION_TOKEN', 'AWS_PROFILE', 'AWS_SHARED_CREDENTIALS_FILE',
+    'AWS_CREDENTIAL_FILE', 'BOTO_CONFIG', 'BOTO_PATH', 'HOME',
+]
+
+
+def daemon_environment():
+    """Return a fingerprint of what a command's results depend on here.
+
+    A daemon only runs commands for clients with the same fingerprint, since
+    it would otherwise run them with its own credentials, cache and umask.
+    The fingerprint is a hash, so that no secret is sent over the socket.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    values = [(name, os.getenv(name))
+              for name in DAEMON_ENVIRONMENT_VARIABLES]
+    values += [('cache', get_user_cache_dir()), ('umask', umask)]
+    # boto reads its configuration, including the credentials that config
+    # load writes, only once, so a daemon started before it changed is stale.
+    for path in [get_user_credential_dir(), os.getenv('BOTO_CONFIG')]:
+        try:
+            config_stat = os.stat(path)
+        except (OSError, TypeError):
+            continue
+        if stat.S_ISREG(config_stat.st_mode):
+            values.append((path, config_stat.st_mtime,
+                           config_stat.st_size))
+    return hashlib.sha256(json.dumps(values)).hexdigest()
+
+
+def read_until_eof(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(64 * 1024)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def call_daemon(path, argv):
+    """Run argv in the daemon listening on path.
+
+    Returns the daemon's response, a dict with the command's stdout, stderr
+    and exit status, or None if no daemon is listening or the daemon refuses
+    the command because it runs in a different environment.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error, e:
+            if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                return None
+            raise
+        sock.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd(),
+                                 'environment': daemon_environment()}))
+        sock.shutdown(socket.SHUT_WR)
+        response = json.loads(read_until_eof(sock))
+        if 'refused' in response:
+            return None
+        return response
+    finally:
+        sock.close()
+
+
+class Captured_Output(object):
+    """A file-like object that collects what a command prints, as UTF-8."""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.parts.append(data)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return b''.join(self.parts).decode('utf-8', 'replace')
 
 
 class App(object):
+    _store = None
+    _cache = None
+    _v_cache = None
+    job_index = None
+
+    def __init__(self):
+        self._connections = {}
+        self._connection_stats = {}
+
+    @property
+    def connection(self):
+        if self.region not in self._connections:
+            import_boto()
+            try:
+                connection = boto.glacier.connect_to_region(self.region)
+            except boto.exception.NoAuthHandlerFound:
+                raise ConsoleError('INCORRECT CONNECTION OR CREDENTIAL')
+            # Every vault and job, and so every transfer worker, shares this
+            # connection's pool of keep-alive HTTP connections.
+            self._connection_stats[self.region] = Connection_Stats(
+                connection.layer1)
+            sign_with_content_hash(connection.layer1)
+            self._connections[self.region] = connection
+        return self._connections[self.region]
+
+    def transfer_controller(self, args):
+        return Transfer_Controller(args.parallel, args.max_bandwidth,
+                                   self._connection_stats.get(self.region))
+
+    @property
+    def account_key(self):
+        # Ask boto rather than searching for credentials here, so that the
+        # cache is always keyed on the account that boto authenticates as.
+        # Making the connection does not touch the network.
+        return get_connection_account(self.connection)
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = Cache_Store()
+        return self._store
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = Archive_Cache(self.store, self.account_key)
+        return self._cache
+
+    @property
+    def v_cache(self):
+        if self._v_cache is None:
+            self._v_cache = Vault_Cache(self.store, self.account_key)
+        return self._v_cache
+
     def job_list(self, args):
-        for vault in self.connection.list_vaults():
-            job_list = [job_oneline(self.connection,
-                                    self.cache,
-                                    vault,
-                                    job)
-                        for job in vault.list_jobs()]
+        if args.json:
+            format_job = job_json
+        else:
+            format_job = job_oneline
+        # Vaults are listed concurrently, but archive names are looked up
+        # here: the cache session must only be used from this thread.
+        for vault, jobs in imap_unordered(self.job_index.jobs,
+                                          list_all_vaults(self.connection),
+                                          args.parallel):
+            names = self.cache.get_archive_names(
+                vault.name,
+                [job.archive_id for job in jobs
+                 if job.action == 'ArchiveRetrieval'])
+            job_list = [format_job(vault, job, names.get(job.archive_id))
+                        for job in jobs]
             if job_list:
                 print(*job_list, sep="\n")
+                sys.stdout.flush()
 
     def config_initialize(self, args):
         try:
@@ -565,34 +2437,21 @@ class App(object):
         print("Daily Free Retrieval in bytes:  ",free_size)
         now = datetime.datetime.now()
         now = now.strftime("%Y %j")
-        size = 0
-        for vault in self.v_cache.get_vault_list(args.region):
-            result = self.v_cache.get_vault(vault,args.region).one()
-            if (result.last_retrieved != now):
-                result.current_retrieval = 0
-                result.last_retrieved = now
-                self.v_cache.mark_commit()
-            size += result.current_retrieval
+        size = self.v_cache.get_current_retrieval(args.region, now)
         print("Today's retrieval in bytes:     ",size)
         loaded_config = config()
         print("Retrieve only if it is free:    ",loaded_config.only_free.rstrip('\n'))
         print("Maximum Retrieval Period (days):",loaded_config.maximum_time_allowance.rstrip('\n'))
 
     def vault_list(self, args):
-        for vault in self.connection.list_vaults():
-            try:
-                result = self.v_cache.get_vault(vault.name,args.region).one()
-                result.size = vault.size
-                self.v_cache.mark_commit()
-            except sqlalchemy.orm.exc.NoResultFound:
-                self.v_cache.add_vault(vault.name, args.region)
-
-        for vault in self.v_cache.get_vault_list(args.region):
-            try:
-                result = self.connection.get_vault(vault)
-                print(result.name,result.size,"bytes")
-            except boto.glacier.exceptions.UnexpectedHTTPResponseError:
-                self.v_cache.delete_vault(vault,args.region)
+        if args.cached:
+            vaults = self.v_cache.get_vault_sizes(args.region)
+        else:
+            vaults = [(vault.name, vault.size)
+                      for vault in list_all_vaults(self.connection)]
+            self.v_cache.reconcile_vaults(args.region, vaults)
+        for name, size in sorted(vaults):
+            print(name,size,"bytes")
 
     def vault_delete(self, args):
         try:
@@ -605,32 +2464,41 @@ class App(object):
         self.connection.create_vault(args.name)
         self.v_cache.add_vault(args.name, args.region)
 
-    def _vault_sync_reconcile(self, vault, job, region, fix=False):
-        response = job.get_output()
-        inventory_date = iso8601_to_unix_timestamp(response['InventoryDate'])
+    def _vault_sync_reconcile(self, vault, job, region, fix=False,
+                              batch_size=10000, progress_interval=10):
+        inventory = Inventory_Reader(get_job_output_stream(job))
+        archives = iter(inventory)
+        self.cache.start_inventory()
+        last_progress = time.time()
+        while True:
+            batch = [(archive['ArchiveId'], archive['ArchiveDescription'],
+                      archive['Size'], archive.get('SHA256TreeHash'))
+                     for archive in itertools.islice(archives, batch_size)]
+            if not batch:
+                break
+            self.cache.stage_inventory(batch)
+            if time.time() - last_progress >= progress_interval:
+                info('inventory for %r: %d archives, %d bytes read' %
+                     (vault.name, inventory.archives_read,
+                      inventory.bytes_read))
+                last_progress = time.time()
+        self.store.commit()
+        inventory_date = iso8601_to_unix_timestamp(
+            inventory.fields['InventoryDate'])
         job_creation_date = iso8601_to_unix_timestamp(job.creation_date)
-        seen_ids = []
-        for archive in response['ArchiveList']:
-            id = archive['ArchiveId']
-            name = archive['ArchiveDescription']
-            creation_date = iso8601_to_unix_timestamp(archive['CreationDate'])
-            size = archive['Size']
-            self.cache.mark_seen_upstream(
-                vault=vault.name,
-                id=id,
-                name=name,
-                upstream_creation_date=creation_date,
-                upstream_inventory_date=inventory_date,
-                upstream_inventory_job_creation_date=job_creation_date,
-                size=size,
-                fix=fix)
-            seen_ids.append(id)
-        self.cache.mark_only_seen(vault.name, inventory_date, seen_ids, fix=fix)
-        self.cache.mark_commit()
-        result = self.v_cache.get_vault(vault.name,region).one()
-        result.last_synced = job.creation_date
-        result.size = vault.size
-        self.v_cache.mark_commit()
+
+        def reconcile():
+            reports = self.cache.mark_staged_seen_upstream(
+                vault.name, inventory_date, job_creation_date, fix=fix)
+            reports += self.cache.mark_only_seen(vault.name, inventory_date,
+                                                 fix=fix)
+            for result in self.v_cache.get_vault(vault.name,region):
+                result.last_synced = job.creation_date
+                result.size = vault.size
+            return reports
+        # Reported only once committed, as reconcile may run more than once.
+        for report, message in self.store.write(reconcile):
+            report(message)
 
     def _vault_sync(self, vault_name, max_age_hours, fix, wait, region):
         try:
@@ -638,7 +2506,7 @@ class App(object):
         except boto.glacier.exceptions.UnexpectedHTTPResponseError:
             print("VAULT NOT FOUND")
             sys.exit(1)
-        inventory_jobs = find_inventory_jobs(vault,
+        inventory_jobs = find_inventory_jobs(self.job_index, vault,
                                              max_age_hours=max_age_hours)
 
         complete_job = find_complete_job(inventory_jobs)
@@ -646,15 +2514,19 @@ class App(object):
             self._vault_sync_reconcile(vault, complete_job, region, fix=fix)
         elif has_pending_job(inventory_jobs):
             if wait:
-                complete_job = wait_until_job_completed(inventory_jobs)
+                complete_job = wait_until_job_completed(self.job_index,
+                                                        inventory_jobs)
+                self._vault_sync_reconcile(vault, complete_job, region,
+                                           fix=fix)
             else:
                 raise RetryConsoleError('job still pending for inventory on %r' %
                                         vault.name)
         else:
             try:
-                job = vault.retrieve_inventory()
+                job = vault.retrieve_inventory_job()
+                self.job_index.add(job)
                 if wait:
-                    wait_until_job_completed([job])
+                    job = wait_until_job_completed(self.job_index, [job])
                     self._vault_sync_reconcile(vault, job, region, fix=fix)
                 else:
                     raise RetryConsoleError('queued inventory job for %r' % vault.name)
@@ -670,6 +2542,8 @@ class App(object):
 
     def archive_list(self, args):
         archive_list = list(self.cache.get_archive_list(args.vault))
+        if args.members:
+            archive_list.extend(self.cache.get_member_list(args.vault))
         try:
             time = self.v_cache.get_vault(args.vault, args.region).one().last_synced
         except sqlalchemy.orm.exc.NoResultFound:
@@ -699,26 +2573,231 @@ class App(object):
                 raise RuntimeError('Archive name not specified. Use --name')
             name = os.path.basename(full_name)
         vault = self.connection.get_vault(args.vault)
-        archive_id = vault.create_archive_from_file(file_obj=args.file, description=name)
-        size = os.path.getsize(args.file.name)
-        self.cache.add_archive(args.vault, name, archive_id, size)
+        file_stat = os.fstat(args.file.fileno())
+        size = file_stat.st_size
+        if stat.S_ISREG(file_stat.st_mode):
+            mtime = file_stat.st_mtime
+        else:
+            mtime = None
+        if args.dedupe:
+            import multiprocessing
+            if mtime is None:
+                raise ConsoleError('--dedupe needs a file to upload')
+            # Hashing locally is much faster than uploading, so check first
+            # whether the vault already has this content.
+            try:
+                ref = self.cache.get_archive_ref_by_tree_hash(
+                    args.vault,
+                    file_tree_hash(args.file, size,
+                                   multiprocessing.cpu_count()),
+                    size)
+            except KeyError:
+                pass
+            else:
+                info('%r has the same content as archive %r in %r; '
+                     'not uploading' % (name, ref, args.vault))
+                return
+        controller = self.transfer_controller(args)
+        if mtime is None:
+            # A pipe has no size to go by, and cannot be read twice.
+            part_size = args.part_size or DEFAULT_STREAM_PART_SIZE
+            if not is_valid_part_size(part_size):
+                raise ConsoleError('part size must be a power of two ' +
+                                   'multiple of 1 MiB, up to 4 GiB')
+            archive_id, tree_hash, size = upload_archive_stream(
+                vault, args.file, name, part_size, max(1, args.parallel),
+                controller)
+        else:
+            archive_id, tree_hash = self._upload_file(
+                vault, args.file, name, size, args.part_size, args.parallel,
+                controller)
+        controller.report_totals()
+
+        def record_upload():
+            self.cache.add_archive(args.vault, name, archive_id, size,
+                                   mtime=mtime, sha256_tree_hash=tree_hash)
+            self.v_cache.add_vault_size(args.vault, args.region, size)
+        self.store.write(record_upload)
 
     @staticmethod
-    def _write_archive_retrieval_job(f, job, multipart_size):
-        if job.archive_size > multipart_size:
-            def fetch(start, end):
-                byte_range = start, end-1
-                f.write(job.get_output(byte_range).read())
-
-            whole_parts = job.archive_size // multipart_size
-            for first_byte in xrange(0, whole_parts * multipart_size,
-                                multipart_size):
-                fetch(first_byte, first_byte + multipart_size)
-            remainder = job.archive_size % multipart_size
-            if remainder:
-                fetch(job.archive_size - remainder, job.archive_size)
+    def _upload_file(vault, file_obj, name, size, part_size, parallel,
+                     controller=None):
+        """Upload file_obj as an archive; return its ID and tree hash."""
+        if controller is None:
+            controller = Transfer_Controller(parallel)
+        if part_size is None:
+            part_size = boto.glacier.utils.minimum_part_size(
+                size, DEFAULT_PART_SIZE)
+        elif not is_valid_part_size(part_size):
+            raise ConsoleError('part size must be a power of two ' +
+                               'multiple of 1 MiB, up to 4 GiB')
+        if size:
+            # boto's archive writer uploads in parts as well, but cannot
+            # retry one.
+            return upload_archive_multipart(
+                vault, file_obj, name, size, part_size, parallel, controller)
         else:
-            f.write(job.get_output().read())
+            writer = vault.create_archive_writer(description=name,
+                                                 part_size=part_size)
+            while True:
+                data = file_obj.read(part_size)
+                if not data:
+                    break
+                writer.write(data)
+            writer.close()
+            return (writer.get_archive_id(),
+                    boto.glacier.utils.bytes_to_hex(writer.current_tree_hash))
+
+    def archive_upload_tree(self, args, commit_size=100, commit_interval=10):
+        vault = self.connection.get_vault(args.vault)
+        # Files already uploaded, unchanged since, are skipped.
+        uploaded = self.cache.get_archive_file_stats(args.vault)
+        files = []
+        small_files = []
+        skipped = 0
+        for dirpath, dirnames, filenames in os.walk(args.directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                try:
+                    file_stat = os.stat(path)
+                except OSError, e:
+                    warn('cannot upload %r: %s' % (path, e.strerror))
+                    continue
+                if not stat.S_ISREG(file_stat.st_mode):
+                    continue
+                try:
+                    # Decoded, since the cache's names are unicode and an
+                    # undecoded non-ASCII name would never be skipped.
+                    name = os.path.relpath(path, args.directory).decode(
+                        'utf-8')
+                except UnicodeDecodeError:
+                    warn('cannot upload %r: name is not UTF-8' % path)
+                    continue
+                if (name, file_stat.st_size, file_stat.st_mtime) in uploaded:
+                    skipped += 1
+                    continue
+                if args.pack_below and file_stat.st_size < args.pack_below:
+                    small_files.append((path, name, file_stat.st_size,
+                                        file_stat.st_mtime))
+                else:
+                    files.append((None, [(path, name, file_stat.st_size,
+                                          file_stat.st_mtime)]))
+
+        # Each upload is (bundle_name, files): bundles pack small files
+        # together up to around bundle_size; other files go up on their own.
+        bundle_prefix = 'bundle-%s-' % time.strftime('%Y%m%dT%H%M%SZ',
+                                                     time.gmtime())
+        bundle = []
+        bundle_size = 0
+        for small_file in small_files:
+            bundle.append(small_file)
+            bundle_size += tarfile.BLOCKSIZE + small_file[2]
+            if bundle_size >= args.bundle_size:
+                files.append(('%s%d.tar' % (bundle_prefix, len(files)),
+                              bundle))
+                bundle = []
+                bundle_size = 0
+        if bundle:
+            files.append(('%s%d.tar' % (bundle_prefix, len(files)), bundle))
+        total_files = len(small_files) + sum(
+            1 for bundle_name, _ in files if bundle_name is None)
+        # Shared by all the uploads, which run one part at a time each.
+        controller = self.transfer_controller(args)
+
+        def upload(item):
+            bundle_name, bundle_files = item
+            try:
+                if bundle_name is None:
+                    path, name, size, mtime = bundle_files[0]
+                    with open(path, 'rb') as f:
+                        archive = self._upload_file(vault, f, name, size,
+                                                    None, 1, controller)
+                    return archive, size, None, None
+                with tempfile.TemporaryFile() as f:
+                    members = pack_bundle(bundle_files, f)
+                    size = f.tell()
+                    f.seek(0)
+                    archive = self._upload_file(vault, f, bundle_name,
+                                                size, None, 1, controller)
+                return archive, size, members, None
+            except Exception, e:
+                return None, None, None, e
+
+        # Archives are recorded from this thread in batches, since the cache
+        # session must only be used from one thread.
+        done = []
+
+        def record_uploads():
+            for name, size, mtime, (archive_id, tree_hash), members in done:
+                self.cache.add_archive(args.vault, name, archive_id, size,
+                                       mtime=mtime,
+                                       sha256_tree_hash=tree_hash)
+                self.v_cache.add_vault_size(args.vault, args.region, size)
+                for member in members:
+                    self.cache.add_member(args.vault, archive_id, *member)
+
+        start = last_commit = time.time()
+        uploaded_files = uploaded_bytes = failed = 0
+        try:
+            for (bundle_name, bundle_files), (
+                    archive, size, members, error) in (
+                        imap_unordered(upload, files, args.parallel)):
+                if error is not None:
+                    warn('failed to upload %r: %s' % (
+                        bundle_name or bundle_files[0][0], error))
+                    failed += len(bundle_files)
+                    continue
+                if members is None:
+                    path, name, _, mtime = bundle_files[0]
+                    done.append((name, size, mtime, archive, []))
+                else:
+                    done.append((bundle_name, size, None, archive, members))
+                uploaded_files += len(bundle_files)
+                uploaded_bytes += size
+                if (len(done) >= commit_size or
+                        time.time() - last_commit >= commit_interval):
+                    self.store.write(record_uploads)
+                    del done[:]
+                    last_commit = time.time()
+                    info('uploaded %d of %d files (%d bytes)' %
+                         (uploaded_files, total_files, uploaded_bytes))
+        finally:
+            # Record whatever was uploaded, even if interrupted.
+            if done:
+                self.store.write(record_uploads)
+        elapsed = max(time.time() - start, 0.001)
+        info('uploaded %d files (%d bytes) in %.1f seconds, %.2f MB/s; ' %
+             (uploaded_files, uploaded_bytes, elapsed,
+              uploaded_bytes / elapsed / MEGABYTE) +
+             '%d unchanged files skipped' % skipped)
+        controller.report_totals()
+        if failed:
+            raise ConsoleError('%d files failed to upload' % failed)
+
+    @staticmethod
+    def _write_archive_retrieval_job(f, job, multipart_size, controller=None):
+        if job.archive_size <= multipart_size:
+            tree_hash = copy_job_output(job, None, f.write,
+                                        controller=controller)
+        elif is_valid_part_size(multipart_size):
+            # Every range is a complete subtree of the archive's tree hash.
+            tree_hash = boto.glacier.utils.tree_hash(
+                [copy_job_output(job, (start, end - 1), f.write,
+                                 controller=controller)
+                 for start, end in byte_ranges(job.archive_size,
+                                               multipart_size)])
+        else:
+            hasher = Tree_Hasher()
+
+            def write(data):
+                hasher.update(data)
+                f.write(data)
+
+            for start, end in byte_ranges(job.archive_size, multipart_size):
+                copy_job_output(job, (start, end - 1), write,
+                                controller=controller)
+            tree_hash = hasher.digest()
 
         # Make sure that the file now exactly matches the downloaded archive,
         # even if the file existed before and was longer.
@@ -729,64 +2808,279 @@ class App(object):
             # this case.
             if e.errno != errno.ESPIPE:
                 raise
+        return tree_hash
+
+    @staticmethod
+    def _write_archive_retrieval_job_parallel(filename, job, multipart_size,
+                                              parallel, controller=None):
+        journal = Range_Journal(filename, job.archive_id, job.archive_size,
+                                multipart_size)
+        ranges = byte_ranges(job.archive_size, multipart_size)
+        missing = journal.missing(ranges)
+        if journal.done:
+            info('resuming retrieval of %r: %d bytes left to fetch' %
+                 (filename, sum(end - start for start, end in missing)))
+            mode = 'r+b'
+        else:
+            mode = 'wb'
+        # Preallocate the whole file up front so that each range can be
+        # written at its own offset as soon as it arrives.
+        with open(filename, mode) as f:
+            f.truncate(job.archive_size)
+
+        def fetch(byte_range):
+            start, end = byte_range
+            fd = os.open(filename, os.O_WRONLY)
+            try:
+                position = [start]
+
+                def write(data):
+                    pwrite(fd, data, position[0])
+                    position[0] += len(data)
+
+                tree_hash = copy_job_output(job, (start, end - 1), write,
+                                            controller=controller)
+                if position[0] != end:
+                    raise RuntimeError(
+                        'short read for bytes %d-%d of %r' %
+                        (start, end - 1, filename))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            journal.mark_done(byte_range,
+                              boto.glacier.utils.bytes_to_hex(tree_hash))
+
+        run_in_parallel(fetch, missing, parallel)
+        journal.remove()
+        if not is_valid_part_size(multipart_size):
+            warn('--multipart-size is not a power of two multiple of 1 MiB; '
+                 'not verifying the tree hash of %r' % filename)
+            return None
+        return boto.glacier.utils.tree_hash(
+            [binascii.unhexlify(journal.done[r]) for r in ranges])
+
+    @staticmethod
+    def _write_archive_retrieval_job_ordered(f, job, multipart_size, parallel,
+                                             buffer_size, controller=None):
+        """Fetch ranges of job output concurrently and write them to f in order.
+
+        Ranges that arrive ahead of their turn wait in a reorder buffer of up
+        to buffer_size bytes. A worker takes a slot in the buffer before it
+        takes the next range, so workers stop fetching while f is slow, and the
+        range that f is waiting for always has a slot.
+        """
+        ranges = byte_ranges(job.archive_size, multipart_size)
+        slots = max(1, min(buffer_size // multipart_size, len(ranges)))
+        free_slots = threading.Semaphore(slots)
+        lock = threading.Condition()
+        fetched = {}
+        errors = []
+        next_index = [0]
+
+        def worker():
+            while True:
+                free_slots.acquire()
+                with lock:
+                    index = next_index[0]
+                    if errors or index == len(ranges):
+                        # Pass the slot on, to wake any other waiting worker.
+                        free_slots.release()
+                        return
+                    next_index[0] += 1
+                start, end = ranges[index]
+                chunks = []
+                try:
+                    tree_hash = copy_job_output(job, (start, end - 1),
+                                                chunks.append,
+                                                controller=controller)
+                    data = b''.join(chunks)
+                    if len(data) != end - start:
+                        raise RuntimeError('short read for bytes %d-%d' %
+                                           (start, end - 1))
+                except Exception:
+                    with lock:
+                        errors.append(sys.exc_info())
+                        lock.notify_all()
+                    free_slots.release()
+                    return
+                with lock:
+                    fetched[index] = (data, tree_hash)
+                    lock.notify_all()
+
+        for _ in xrange(min(parallel, slots)):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+        aligned = is_valid_part_size(multipart_size)
+        tree_hashes = []
+        hasher = Tree_Hasher()
+        for index in xrange(len(ranges)):
+            with lock:
+                while index not in fetched and not errors:
+                    # Wait with a timeout so that KeyboardInterrupt is
+                    # delivered.
+                    lock.wait(1)
+                if errors:
+                    exc_type, exc_value, exc_traceback = errors[0]
+                    raise exc_type, exc_value, exc_traceback
+                data, tree_hash = fetched.pop(index)
+            f.write(data)
+            free_slots.release()
+            if aligned:
+                # Every range is a complete subtree of the archive's tree
+                # hash.
+                tree_hashes.append(tree_hash)
+            else:
+                hasher.update(data)
+        f.flush()
+        if aligned:
+            return boto.glacier.utils.tree_hash(tree_hashes)
+        return hasher.digest()
 
-    @classmethod
-    def _archive_retrieve_completed(cls, args, job, name):
+    def _archive_retrieve_completed(self, args, job, name, controller):
         if args.output_filename == '-':
-            cls._write_archive_retrieval_job(
-                sys.stdout, job, args.multipart_size)
+            if args.parallel > 1 and job.archive_size > args.multipart_size:
+                tree_hash = self._write_archive_retrieval_job_ordered(
+                    sys.stdout, job, args.multipart_size, args.parallel,
+                    args.reorder_buffer or
+                    2 * args.parallel * args.multipart_size, controller)
+            else:
+                tree_hash = self._write_archive_retrieval_job(
+                    sys.stdout, job, args.multipart_size, controller)
         else:
             if args.output_filename:
                 filename = args.output_filename
             else:
                 filename = os.path.basename(name)
-            with open(filename, 'wb') as f:
-                cls._write_archive_retrieval_job(f, job, args.multipart_size)
+            if job.archive_size > args.multipart_size:
+                tree_hash = self._write_archive_retrieval_job_parallel(
+                    filename, job, args.multipart_size, args.parallel,
+                    controller)
+            else:
+                with open(filename, 'wb') as f:
+                    tree_hash = self._write_archive_retrieval_job(
+                        f, job, args.multipart_size, controller)
+        check_archive_tree_hash(job, tree_hash, name)
 
-    def archive_retrieve_one(self, args, name,free,used):
+    def _archive_range_retrieve_completed(self, args, job, controller, name,
+                                          offset, size, sha256=None):
+        if args.output_filename == '-':
+            f = sys.stdout
+        elif args.output_filename:
+            f = open(args.output_filename, 'wb')
+        else:
+            f = open(os.path.basename(name), 'wb')
+        # The job may have retrieved more of the archive than is wanted.
+        job_range = job_byte_range(job)
+        if job_range is not None:
+            offset -= job_range[0]
         try:
-            archive_id = self.cache.get_archive_id(args.vault, name)
-        except KeyError:
-            raise ConsoleError('archive %r not found or multiple occurance' % name)
-        result = self.cache._get_archive_query_by_ref(args.vault, name).one()
-            
+            digest = hashlib.sha256()
+
+            def write(data):
+                digest.update(data)
+                f.write(data)
+            if size:
+                copy_job_output(job, (offset, offset + size - 1), write,
+                                controller=controller)
+        finally:
+            if f is not sys.stdout:
+                f.close()
+        if sha256 and digest.hexdigest() != sha256:
+            raise ConsoleError('member %r failed verification' % name)
+
+    def archive_retrieve_one(self, args, vault, name, free, used, poller,
+                             retrieved, controller):
+        if name.startswith('member:'):
+            # A file packed into a bundle: retrieve just its part of the
+            # bundle archive.
+            try:
+                member = self.cache.get_member(args.vault, name[7:])
+            except KeyError:
+                raise ConsoleError('member %r not found or multiple occurance' % name)
+            if args.range:
+                raise ConsoleError('cannot use --range with member %r' % name)
+            archive_id = member.archive_id
+            result = self.cache._get_archive_query_by_ref(
+                args.vault, 'id:' + archive_id).one()
+            # Copied here, as the job may complete in another thread.
+            wanted = (member.name, member.offset, member.size, member.sha256)
+        else:
+            try:
+                archive_id = self.cache.get_archive_id(args.vault, name)
+            except KeyError:
+                raise ConsoleError('archive %r not found or multiple occurance' % name)
+            result = self.cache._get_archive_query_by_ref(args.vault, name).one()
+            if args.range:
+                start, end = args.range
+                if start >= result.size:
+                    raise ConsoleError('archive %r is only %d bytes' %
+                                       (name, result.size))
+                end = min(end, result.size - 1)
+                wanted = (name, start, end - start + 1, None)
+            else:
+                wanted = None
 
-        vault = self.connection.get_vault(args.vault)
-        retrieval_jobs = find_retrieval_jobs(vault, archive_id)
+        if wanted is None:
+            byte_range = job_range = None
+            retrieval_size = result.size
 
-        complete_job = find_complete_job(retrieval_jobs)
-        if complete_job:
-            self._archive_retrieve_completed(args, complete_job, name)
+            def completed(job):
+                self._archive_retrieve_completed(args, job, name, controller)
+        else:
+            offset, size = wanted[1:3]
+            byte_range = (offset, offset + max(size, 1) - 1)
+            job_range = align_byte_range(byte_range[0], byte_range[1],
+                                         result.size)
+            retrieval_size = job_range[1] - job_range[0] + 1
+
+            def completed(job):
+                self._archive_range_retrieve_completed(args, job, controller,
+                                                       *wanted)
+
+        def download(job):
+            # Only reported once the archive is downloaded and verified.
+            completed(job)
+            retrieved.append('retrieved archive %r' % name)
+
+        retrieval_jobs = find_retrieval_jobs(self.job_index, vault, archive_id,
+                                             byte_range)
+
+        if find_complete_job(retrieval_jobs):
+            poller.add(retrieval_jobs, download)
         elif has_pending_job(retrieval_jobs):
             if args.wait:
-                complete_job = wait_until_job_completed(retrieval_jobs)
-                self._archive_retrieve_completed(args, complete_job, name)
+                poller.add(retrieval_jobs, download)
             else:
                 raise RetryConsoleError('job still pending for archive %r' % name)
         else:
             print("Retrieving for free:                ",free-used,"bytes")
-            print("Retrieving archive with the size of:",result.size,"bytes")
+            print("Retrieving archive with the size of:",retrieval_size,"bytes")
             loaded_config = config()
-            if (free-used < result.size):
-                if(loaded_config.only_free.rstrip('\n')=="yes"):
-                    print("Retrieval Not Free")
-                else:
-                    # create an archive retrieval job
+            if (free-used < retrieval_size and
+                    loaded_config.only_free.rstrip('\n') == "yes"):
+                print("Retrieval Not Free")
+            else:
+                # create an archive retrieval job
+                if job_range is None:
                     job = vault.retrieve_archive(archive_id)
-        
-                    result = self.v_cache.get_vault(vault.name,args.region).one()
-                    result.current_retrieval += job.archive_size
-                    self.v_cache.mark_commit()
+                else:
+                    job = retrieve_archive_range(vault, archive_id, job_range)
+                self.job_index.add(job)
+
+                self.v_cache.add_current_retrieval(vault.name, args.region,
+                                                   job_output_size(job))
 
-                    if args.wait:
-                        wait_until_job_completed([job])
-                        self._archive_retrieve_completed(args, job, name)
-                    else:
-                        raise RetryConsoleError('queued retrieval job for archive %r' % name)
+                if args.wait:
+                    poller.add([job], download)
+                else:
+                    raise RetryConsoleError('queued retrieval job for archive %r' % name)
 
     def archive_retrieve(self, args):
         if len(args.names) > 1 and args.output_filename:
             raise ConsoleError('cannot specify output filename with multi-archive retrieval')
+        if len(args.names) > 1 and args.range:
+            raise ConsoleError('cannot specify a byte range with multi-archive retrieval')
         success_list = []
         retry_list = []
         
@@ -796,23 +3090,30 @@ class App(object):
         ##print("Daily Allowance in bytes:",free_size)
         now = datetime.datetime.now()
         now = now.strftime("%Y %j")
-        size = 0
-        for vault in self.v_cache.get_vault_list(args.region):
-            result = self.v_cache.get_vault(vault,args.region).one()
-            if (result.last_retrieved != now):
-                result.current_retrieval = 0
-                result.last_retrieved = now
-                self.v_cache.mark_commit()
-            size += result.current_retrieval
+        size = self.v_cache.get_current_retrieval(args.region, now)
         ##print("Today you've retrieved in bytes:",size)
 
+        # With --wait, every pending job is waited on together and each
+        # archive is downloaded as soon as its own job completes.
+        poller = Job_Poller(self.job_index)
+        # Shared by every archive downloaded, so that --parallel and
+        # --max-bandwidth hold for the command as a whole.
+        controller = self.transfer_controller(args)
+        vault = self.connection.get_vault(args.vault)
         for name in args.names:
             try:
-                self.archive_retrieve_one(args, name,free_size,size)
+                self.archive_retrieve_one(args, vault, name, free_size, size,
+                                          poller, success_list, controller)
             except RetryConsoleError, e:
                 retry_list.append(e.message)
-            else:
-                success_list.append('retrieved archive %r' % name)
+            except ConsoleError:
+                # Finish the downloads already under way rather than exit
+                # part way through them.
+                exc_info = sys.exc_info()
+                poller.join()
+                raise exc_info[0], exc_info[1], exc_info[2]
+        poller.run()
+        controller.report_totals()
         if retry_list:
             message_list = success_list + retry_list
             raise RetryConsoleError("\n".join(message_list))
@@ -827,15 +3128,72 @@ class App(object):
         self.cache.delete_archive(args.vault, args.name)
 
     def archive_checkpresent(self, args):
+        if args.batch == (args.name is not None):
+            raise ConsoleError('specify either an archive name or --batch')
+        if args.batch:
+            # Every name is looked up in one query's results instead of a
+            # query each. Refs by ID are rare enough to look up one by one.
+            last_seen_by_name = self.cache.get_archive_last_seen_by_name(
+                args.vault)
+
+            def get_last_seen(ref):
+                if ref.startswith('id:'):
+                    return self.cache.get_archive_last_seen(args.vault, ref)
+                if ref.startswith('name:'):
+                    ref = ref[5:]
+                return last_seen_by_name[ref]
+        else:
+            def get_last_seen(ref):
+                return self.cache.get_archive_last_seen(args.vault, ref)
+
+        # However many names are checked, the vault is synced at most once.
+        synced = []
+
+        def sync():
+            if not synced:
+                try:
+                    self._vault_sync(vault_name=args.vault,
+                                     max_age_hours=args.max_age_hours,
+                                     fix=False,
+                                     wait=args.wait, region=args.region)
+                except RetryConsoleError:
+                    synced.append(False)
+                else:
+                    synced.append(True)
+                    if args.batch:
+                        last_seen_by_name.clear()
+                        last_seen_by_name.update(
+                            self.cache.get_archive_last_seen_by_name(
+                                args.vault))
+            return synced[0]
+
+        if args.batch:
+            # Answer each line as it arrives, so that a caller can keep a
+            # pipe open and wait for each answer.
+            for line in iter(sys.stdin.readline, b''):
+                name = line.rstrip(b'\n')
+                # The cache's names are unicode, which an undecoded
+                # non-ASCII name never matches.
+                if self._archive_present(args, name.decode('utf-8', 'replace'),
+                                         get_last_seen, sync):
+                    print(name)
+                else:
+                    print()
+                sys.stdout.flush()
+        elif self._archive_present(args, args.name, get_last_seen, sync):
+            print(args.name)
+
+    @staticmethod
+    def _archive_present(args, name, get_last_seen, sync):
         try:
-            last_seen = self.cache.get_archive_last_seen(args.vault, args.name)
+            last_seen = get_last_seen(name)
         except KeyError:
             if args.wait:
                 last_seen = None
             else:
                 if not args.quiet:
-                    print('archive %r not found or multiple occurance' % args.name, file=sys.stderr)
-                return
+                    print('archive %r not found or multiple occurance' % name, file=sys.stderr)
+                return False
 
         def too_old(last_seen):
             return not last_seen or not args.max_age_hours or (
@@ -843,41 +3201,126 @@ class App(object):
 
         if too_old(last_seen):
             # Not recent enough
-            try:
-                self._vault_sync(vault_name=args.vault,
-                                 max_age_hours=args.max_age_hours,
-                                 fix=False,
-                                 wait=args.wait)
-            except RetryConsoleError:
-                pass
-            else:
+            if sync():
                 try:
-                    last_seen = self.cache.get_archive_last_seen(args.vault,
-                                                                 args.name)
+                    last_seen = get_last_seen(name)
                 except KeyError:
                     if not args.quiet:
                         print(('archive %r not found, but it may ' +
                                            'not be in the inventory yet')
-                                           % args.name, file=sys.stderr)
-                    return
+                                           % name, file=sys.stderr)
+                    return False
 
         if too_old(last_seen):
             if not args.quiet:
                 print(('archive %r found, but has not been seen ' +
                                    'recently enough to consider it present') %
-                                   args.name, file=sys.stderr)
-            return
+                                   name, file=sys.stderr)
+            return False
 
-        print(args.name)
+        return True
 
 
-    def main(self):
-        
-        loaded_config = config()
-        default_region = 'us-east-1'
-        default_region = loaded_config.default_region.rstrip('\n')      
+    def daemon(self, args):
+        """Serve commands from clients on a Unix socket, one at a time.
+
+        The connection, caches and job index stay open between commands, so
+        each one only pays for the work it actually does.
+        """
+        path = args.socket or get_daemon_socket_path()
+        mkdir_p(os.path.dirname(path))
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.connect(path)
+        except socket.error, e:
+            if e.errno == errno.ECONNREFUSED:
+                # Left behind by a daemon that did not exit cleanly.
+                os.unlink(path)
+            elif e.errno != errno.ENOENT:
+                raise
+        else:
+            server.close()
+            raise ConsoleError('a daemon is already listening on %r' % path)
+        server.close()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Commands run with our credentials, so only we may connect.
+        old_umask = os.umask(0177)
+        try:
+            server.bind(path)
+        finally:
+            os.umask(old_umask)
+        server.listen(16)
+        parser = self.build_parser()
+        environment = daemon_environment()
+        self.job_index = Job_Index(max_age=DAEMON_JOB_LIST_MAX_AGE)
+        info('listening on %r' % path)
+        try:
+            while True:
+                sock, _ = server.accept()
+                try:
+                    request = read_until_eof(sock)
+                    # Another daemon checking whether this one is running.
+                    if not request:
+                        continue
+                    request = json.loads(request)
+                    if request.get('environment') != environment:
+                        # The client runs the command itself instead.
+                        sock.sendall(json.dumps(
+                            {'refused': 'different environment'}))
+                        continue
+                    sock.sendall(json.dumps(
+                        self.serve(parser, request['argv'], request['cwd'])))
+                except (socket.error, ValueError, KeyError), e:
+                    warn('bad request: %s' % e)
+                finally:
+                    sock.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.unlink(path)
+
+    def serve(self, parser, argv, cwd):
+        """Run a command for a daemon client, capturing its output."""
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = Captured_Output(), Captured_Output()
+        try:
+            try:
+                os.chdir(cwd)
+                args = parser.parse_args(argv)
+                if self.runs_locally(args):
+                    raise ConsoleError('this command cannot be run by the '
+                                       'daemon')
+                status = self.run(args)
+            except SystemExit, e:
+                if e.code is None or isinstance(e.code, int):
+                    status = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+                    status = 1
+            except ConsoleError, e:
+                print(insert_prefix_to_lines(PROGRAM_NAME + ': ', e.message),
+                      file=sys.stderr)
+                status = 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            response = {'stdout': sys.stdout.getvalue(),
+                        'stderr': sys.stderr.getvalue(),
+                        'status': status}
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            # Anything read from the cache may be changed by other processes
+            # before the next command.
+            if self._store is not None:
+                self._store.session.close()
+        return response
+
+    def build_parser(self):
         parser = argparse.ArgumentParser()
-        parser.add_argument('--region', default=default_region)
+        # The default comes from the configuration when the command is run,
+        # since a daemon may outlive a change to it.
+        parser.add_argument('--region')
         subparsers = parser.add_subparsers()
 
         config_subparser = subparsers.add_parser('config').add_subparsers()
@@ -902,7 +3345,9 @@ class App(object):
         #develop config download
         
         vault_subparser = subparsers.add_parser('vault').add_subparsers()
-        vault_subparser.add_parser('list').set_defaults(func=self.vault_list)
+        vault_list_subparser = vault_subparser.add_parser('list')
+        vault_list_subparser.set_defaults(func=self.vault_list)
+        vault_list_subparser.add_argument('--cached', action='store_true')
         vault_create_subparser = vault_subparser.add_parser('create')
         vault_create_subparser.set_defaults(func=self.vault_create)
         vault_create_subparser.add_argument('name')
@@ -921,12 +3366,36 @@ class App(object):
         archive_list_subparser = archive_subparser.add_parser('list')
         archive_list_subparser.set_defaults(func=self.archive_list)
         archive_list_subparser.add_argument('vault')
+        archive_list_subparser.add_argument('--members', action='store_true')
         archive_upload_subparser = archive_subparser.add_parser('upload')
         archive_upload_subparser.set_defaults(func=self.archive_upload)
         archive_upload_subparser.add_argument('vault')
         archive_upload_subparser.add_argument('file',
                                               type=argparse.FileType('rb'))
         archive_upload_subparser.add_argument('--name')
+        archive_upload_subparser.add_argument('--parallel', type=int,
+                                              default=1)
+        archive_upload_subparser.add_argument('--part-size', type=int)
+        archive_upload_subparser.add_argument('--dedupe', action='store_true')
+        archive_upload_subparser.add_argument('--max-bandwidth',
+                                              type=parse_size,
+                                              metavar='BYTES_PER_SECOND')
+        archive_upload_tree_subparser = archive_subparser.add_parser(
+                'upload-tree')
+        archive_upload_tree_subparser.set_defaults(
+                func=self.archive_upload_tree)
+        archive_upload_tree_subparser.add_argument('vault')
+        archive_upload_tree_subparser.add_argument('directory')
+        archive_upload_tree_subparser.add_argument('--parallel', type=int,
+                                                   default=4)
+        archive_upload_tree_subparser.add_argument('--pack-below', type=int,
+                                                   metavar='BYTES')
+        archive_upload_tree_subparser.add_argument('--bundle-size', type=int,
+                                                   default=256 * MEGABYTE,
+                                                   metavar='BYTES')
+        archive_upload_tree_subparser.add_argument(
+                '--max-bandwidth', type=parse_size,
+                metavar='BYTES_PER_SECOND')
         archive_retrieve_subparser = archive_subparser.add_parser('retrieve')
         archive_retrieve_subparser.set_defaults(func=self.archive_retrieve)
         archive_retrieve_subparser.add_argument('vault')
@@ -937,6 +3406,16 @@ class App(object):
         archive_retrieve_subparser.add_argument('-o', dest='output_filename',
                                                 metavar='OUTPUT_FILENAME')
         archive_retrieve_subparser.add_argument('--wait', action='store_true')
+        archive_retrieve_subparser.add_argument('--range',
+                                                type=parse_byte_range,
+                                                metavar='START-END')
+        archive_retrieve_subparser.add_argument('--parallel', type=int,
+                                                default=1)
+        archive_retrieve_subparser.add_argument('--reorder-buffer', type=int,
+                                                metavar='BYTES')
+        archive_retrieve_subparser.add_argument('--max-bandwidth',
+                                                type=parse_size,
+                                                metavar='BYTES_PER_SECOND')
         archive_delete_subparser = archive_subparser.add_parser('delete')
         archive_delete_subparser.set_defaults(func=self.archive_delete)
         archive_delete_subparser.add_argument('vault')
@@ -946,7 +3425,9 @@ class App(object):
         archive_checkpresent_subparser.set_defaults(
                 func=self.archive_checkpresent)
         archive_checkpresent_subparser.add_argument('vault')
-        archive_checkpresent_subparser.add_argument('name')
+        archive_checkpresent_subparser.add_argument('name', nargs='?')
+        archive_checkpresent_subparser.add_argument('--batch',
+                                                    action='store_true')
         archive_checkpresent_subparser.add_argument('--wait',
                                                     action='store_true')
         archive_checkpresent_subparser.add_argument('--quiet',
@@ -954,14 +3435,22 @@ class App(object):
         archive_checkpresent_subparser.add_argument(
                 '--max-age', type=int, default=80, dest='max_age_hours')
         job_subparser = subparsers.add_parser('job').add_subparsers()
-        job_subparser.add_parser('list').set_defaults(func=self.job_list)
-        args = parser.parse_args()
-        try:
-            self.connection = boto.glacier.connect_to_region(args.region)
-            self.cache = Archive_Cache(get_connection_account(self.connection))
-            self.v_cache = Vault_Cache(get_connection_account(self.connection))
-        except boto.exception.NoAuthHandlerFound:
-            print ("INCORRECT CONNECTION OR CREDENTIAL")
+        job_list_subparser = job_subparser.add_parser('list')
+        job_list_subparser.set_defaults(func=self.job_list)
+        job_list_subparser.add_argument('--json', action='store_true')
+        job_list_subparser.add_argument('--parallel', type=int, default=8)
+        daemon_subparser = subparsers.add_parser('daemon')
+        daemon_subparser.set_defaults(func=self.daemon)
+        daemon_subparser.add_argument('--socket')
+        return parser
+
+    def run(self, args):
+        """Run the command parsed into args and return its exit status."""
+        if args.region is None:
+            args.region = config().default_region.rstrip('\n')
+        # The connection and caches are opened by the properties above only
+        # if the subcommand actually uses them.
+        self.region = args.region
         try:
             args.func(args)
         except RetryConsoleError, e:
@@ -969,11 +3458,43 @@ class App(object):
             print(message, file=sys.stderr)
             # From sysexits.h:
             #     "temp failure; user is invited to retry"
-            sys.exit(75)  # EX_TEMPFAIL
+            return 75  # EX_TEMPFAIL
         except ConsoleError, e:
             message = insert_prefix_to_lines(PROGRAM_NAME + ': ', e.message)
             print(message, file=sys.stderr)
-            sys.exit(1)
+            return 1
+        return 0
+
+    @staticmethod
+    def runs_locally(args):
+        """Whether args must be run here rather than by a daemon.
+
+        The daemon only returns a command's output once it has finished, so
+        commands that stream data through stdin or stdout run locally. It
+        also runs one command at a time, so transfers and waits for jobs,
+        which can take hours, run locally too rather than hold up every
+        other client. config commands run locally so that the daemon never
+        holds on to a connection or cache for credentials they replace.
+        """
+        return (args.func.__name__.startswith('config_') or
+                args.func.__name__ in ('daemon', 'archive_upload',
+                                       'archive_upload_tree',
+                                       'archive_retrieve') or
+                getattr(args, 'batch', False) or
+                getattr(args, 'wait', False) or
+                getattr(args, 'file', None) is sys.stdin or
+                getattr(args, 'output_filename', None) == '-')
+
+    def main(self):
+        args = self.build_parser().parse_args()
+        if not self.runs_locally(args):
+            response = call_daemon(get_daemon_socket_path(), sys.argv[1:])
+            if response is not None:
+                sys.stdout.write(response['stdout'].encode('utf-8'))
+                sys.stderr.write(response['stderr'].encode('utf-8'))
+                sys.exit(response['status'])
+        self.job_index = Job_Index()
+        sys.exit(self.run(args))
 
 
 if __name__ == '__main__':